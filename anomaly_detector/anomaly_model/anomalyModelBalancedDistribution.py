@@ -8,6 +8,7 @@ import h5py
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.spatial import distance
+from scipy.linalg import solve_triangular
 from tqdm import tqdm
 
 from anomalyModelBase import AnomalyModelBase
@@ -17,6 +18,9 @@ class AnomalyModelBalancedDistribution(AnomalyModelBase):
     """Anomaly model formed by a Balanced Distribution of feature vectors
     Reference: https://www.mdpi.com/2076-3417/9/4/757
     """
+    LEARNING_BATCH_SIZE_MIN = 16    # Number of candidates screened at once while learning (adapts between min and max,
+    LEARNING_BATCH_SIZE_MAX = 4096  # set both to 1 to process one candidate at a time)
+
     def __init__(self, initial_normal_features=1000, threshold_learning=300, threshold_classification=5, pruning_parameter=0.3):
         AnomalyModelBase.__init__(self)
         self.NAME += "/%i/%i/%.2f" % (initial_normal_features, threshold_learning, pruning_parameter)
@@ -33,6 +37,16 @@ class AnomalyModelBalancedDistribution(AnomalyModelBase):
         self._mean = None   # Mean
         self._covI = None   # Inverse of covariance matrix
 
+        # Incremental model (only used while learning)
+        self._count    = 0      # Number of "normal" samples
+        self._basis    = None   # Orthonormal basis of the subspace spanned by the samples
+        self._scatterI = None   # Inverse of scatter matrix in subspace coordinates
+        self._rank      = 0     # Dimension of the subspace
+        self._trace     = 0.0   # Trace of the scatter matrix
+        self._tolerance = None  # Relative threshold for extending the subspace
+
+        self._pruning_start = None
+        self._pruning_end   = None
     
     def classify(self, patch, threshold_classification=None):
         """The anomaly measure is defined as the Mahalanobis distance between a feature sample
@@ -66,10 +80,118 @@ class AnomalyModelBalancedDistribution(AnomalyModelBase):
         
         return distance.mahalanobis(feature, self._mean, self._covI)
 
+    def __mahalanobis_distance_batch__(self, features):
+        """Calculate the Mahalanobis distances between a batch of features (N, D) and the model"""
+        assert not self._covI is None and not self._mean is None, \
+            "You need to load a model before computing a Mahalanobis distance"
+
+        assert features.shape[-1] == self._mean.shape[0] == self._covI.shape[0] == self._covI.shape[1], \
+            "Shapes don't match (x: %s, μ: %s, Σ¯¹: %s)" % (features.shape, self._mean.shape, self._covI.shape)
+
+        diff = features - self._mean
+        return np.sqrt(np.einsum("ij,ij->i", diff.dot(self._covI), diff))
+
+    ########################
+    #  Incremental model   #
+    ########################
+
+    # The covariance of the "normal" distribution is Σ = S / (n - 1) with the scatter matrix S.
+    # S is only positive definite on the subspace spanned by the (centered) samples, so we keep
+    # an orthonormal basis Q of this subspace and the inverse of S in subspace coordinates M¯¹.
+    # Then Σ¯¹ (pseudo inverse) = (n - 1) * Q M¯¹ Qᵀ and every accepted sample is a rank-one update
+    # of S (Sherman-Morrison), or extends the subspace by one dimension (block inverse).
+
+    def _initialize_learning(self, features):
+        """Initialize the incremental model with the initial "normal" features (N, D)"""
+        n, d = features.shape
+
+        self._count = n
+        self._mean = np.mean(features, axis=0, dtype=np.float64)
+
+        # Preallocate basis and inverse scatter matrix for the maximum rank
+        self._basis = np.zeros((d, d), dtype=np.float64)
+        self._scatterI = np.zeros((d, d), dtype=np.float64)
+
+        # Eigen decomposition of the scatter matrix via SVD of the centered features
+        _, sigma, v = np.linalg.svd(features - self._mean, full_matrices=False)
+        eig = sigma ** 2
+
+        self._trace = np.sum(eig)
+        self._tolerance = max(n, d) * np.finfo(np.float64).eps     # Same as np.linalg.matrix_rank
+
+        keep = eig > self._tolerance * self._trace
+        self._rank = np.count_nonzero(keep)
+
+        self._basis[:, :self._rank] = v[keep].T
+        self._scatterI[:self._rank, :self._rank] = np.diag(1.0 / eig[keep])
+
+    def _learning_distances(self, features):
+        """Mahalanobis distances (N,) of features (N, D) to the current incremental model"""
+        r = self._rank
+        z = (features - self._mean).dot(self._basis[:, :r])
+        return np.sqrt(max(self._count - 1, 1) * np.einsum("ij,ij->i", z.dot(self._scatterI[:r, :r]), z))
+
+    def _add_to_distribution(self, feature):
+        """Add a single feature vector (D,) to the incremental model"""
+        n = self._count
+        r = self._rank
+        c = n / (n + 1.0)
+
+        u = feature - self._mean
+        self._mean += u / (n + 1.0)
+        self._trace += c * u.dot(u)
+        self._count += 1
+
+        Q = self._basis[:, :r]
+        M = self._scatterI[:r, :r]
+
+        # Project onto the current subspace (twice for numerical orthogonality)
+        p = Q.T.dot(u)
+        residual = u - Q.dot(p)
+        p2 = Q.T.dot(residual)
+        p += p2
+        residual -= Q.dot(p2)
+
+        rho2 = residual.dot(residual)
+
+        w = M.dot(p)
+        alpha = p.dot(w)
+
+        if r < self._basis.shape[0] and c * rho2 > self._tolerance * self._trace:
+            # The sample adds a new dimension to the subspace
+            rho = np.sqrt(rho2)
+            self._basis[:, r] = residual / rho
+            self._scatterI[:r, r] = -w / rho
+            self._scatterI[r, :r] = -w / rho
+            self._scatterI[r, r] = (1 + c * alpha) / (c * rho2)
+            self._rank += 1
+        else:
+            # Sherman-Morrison: (S + c u uᵀ)¯¹
+            M -= np.outer(w, w) * (c / (1 + c * alpha))
+
+    def _pruning_distances(self, features):
+        """Mahalanobis distances (N,) of all the "normal" features (N, D) to the incremental model.
+        Uses a Cholesky solve with the scatter matrix of the features in subspace coordinates."""
+        Q = self._basis[:, :self._rank]
+        z = (features - self._mean).dot(Q)
+        try:
+            L = np.linalg.cholesky(z.T.dot(z))
+        except np.linalg.LinAlgError:
+            # Numerically not positive definite, use the incrementally updated inverse instead
+            return self._learning_distances(features)
+        y = solve_triangular(L, z.T, lower=True)
+        return np.sqrt(max(self._count - 1, 1) * np.einsum("ij,ij->j", y, y))
+
+    def _finish_learning(self):
+        """Free the incremental model"""
+        self._basis = None
+        self._scatterI = None
+
     def __generate_model__(self, patches, silent=False):
         if not silent: logger.info("Generating a Balanced Distribution from %i feature vectors of length %i" % (len(patches.ravel()), patches.features.shape[-1]))
 
         patches_flat = patches.ravel()
+        features = patches_flat.features
 
         if patches_flat.shape[0] < self.initial_normal_features:
             self.initial_normal_features = patches_flat.shape[0]
@@ -77,52 +199,66 @@ class AnomalyModelBalancedDistribution(AnomalyModelBase):
         #     "Not enough initial features provided. Please decrease initial_normal_features (%i)" % self.initial_normal_features
 
         # Create initial set of "normal" vectors
-        self.balanced_distribution = patches_flat[:self.initial_normal_features]
+        self._initialize_learning(features[:self.initial_normal_features])
 
-        self._calculate_mean_and_covariance()
+        # Indices of the "normal" vectors (preallocated for the worst case)
+        indices = np.empty(patches_flat.shape[0], dtype=np.intp)
+        indices[:self.initial_normal_features] = np.arange(self.initial_normal_features)
+        count = self.initial_normal_features
 
         # Loop over the remaining feature vectors
+        # A block of candidates is screened against the current model at once. Only the first
+        # candidate over the threshold is accepted, screening then continues right after it
+        # with the updated model, so the result is the same as processing one vector at a time.
+        i = self.initial_normal_features
+        batch_size = self.LEARNING_BATCH_SIZE_MIN
         with tqdm(desc="Creating balanced distribution",
                     initial=self.initial_normal_features,
                     total=patches_flat.shape[0],
                     file=sys.stderr) as pbar:
-            for patch in patches_flat[self.initial_normal_features:]:
-                # Calculate the Mahalanobis distance to the "normal" distribution
-                dist = self.__mahalanobis_distance__(patch)
-                if dist > self.threshold_learning:
-                    # Add the vector to the "normal" distribution
-                    self.balanced_distribution = np.append(self.balanced_distribution, [patch], axis=0)
-
-                    # Recalculate mean and covariance
-                    self._calculate_mean_and_covariance()
-                
-                # Print progress
-                pbar.set_postfix({"Balanced Distribution": len(self.balanced_distribution)})
-                pbar.update()
+            pbar.set_postfix({"Balanced Distribution": count})
+            while i < patches_flat.shape[0]:
+                # Calculate the Mahalanobis distances of the block to the "normal" distribution
+                candidates = features[i:i + batch_size]
+                over_threshold = np.flatnonzero(self._learning_distances(candidates) > self.threshold_learning)
+
+                if over_threshold.size == 0:
+                    processed = candidates.shape[0]
+                    batch_size = min(batch_size * 2, self.LEARNING_BATCH_SIZE_MAX)
+                else:
+                    # Add the first vector over the threshold to the "normal" distribution (updates mean and covariance)
+                    j = i + over_threshold[0]
+                    self._add_to_distribution(features[j])
+                    indices[count] = j
+                    count += 1
+
+                    processed = over_threshold[0] + 1
+                    batch_size = min(max(processed * 2, self.LEARNING_BATCH_SIZE_MIN), self.LEARNING_BATCH_SIZE_MAX)
+                    
+                    # Print progress
+                    pbar.set_postfix({"Balanced Distribution": count})
+
+                i += processed
+                pbar.update(processed)
+
+        self.balanced_distribution = patches_flat[indices[:count]]
 
         # Prune the distribution
-        
-        if not silent: logger.info(np.mean(np.array([self.__mahalanobis_distance__(f) for f in self.balanced_distribution])))
+        self._pruning_start = time.time()
 
-        prune_filter = np.empty(self.balanced_distribution.shape, dtype=np.bool)
-        pruned = 0
-        
-        with tqdm(desc="Pruning balanced distribution",
-                    total=len(self.balanced_distribution),
-                    file=sys.stderr) as pbar:
-            for i, patch in enumerate(self.balanced_distribution):
-                not_prune = self.__mahalanobis_distance__(patch) > self.threshold_learning * self.pruning_parameter
-                prune_filter[i] = not_prune
+        dist = self._pruning_distances(self.balanced_distribution.features)
 
-                if not not_prune:
-                    pruned += 1
+        if not silent: logger.info(np.mean(dist))
 
-                # Print progress
-                pbar.set_postfix({"Pruned": pruned})
-                pbar.update()
+        prune_filter = dist > self.threshold_learning * self.pruning_parameter
+        
+        self._finish_learning()
 
         self.balanced_distribution = self.balanced_distribution[prune_filter]
 
+        self._pruning_end = time.time()
+
+        if not silent: logger.info("Pruned %i entries in %s" % (np.count_nonzero(~prune_filter), utils.format_duration(self._pruning_end - self._pruning_start)))
         if not silent: logger.info("Generated Balanced Distribution with %i entries" % len(self.balanced_distribution))
     
         self._calculate_mean_and_covariance()
@@ -155,6 +291,12 @@ class AnomalyModelBalancedDistribution(AnomalyModelBase):
         h5file.attrs["threshold_learning"]         = self.threshold_learning
         h5file.attrs["threshold_classification"]   = self.threshold_classification
         h5file.attrs["pruning_parameter"]          = self.pruning_parameter
+
+        if self._pruning_start is not None and self._pruning_end is not None:
+            h5file.attrs["Pruning start"] = self._pruning_start
+            h5file.attrs["Pruning end"] = self._pruning_end
+            h5file.attrs["Pruning duration"] = self._pruning_end - self._pruning_start
+            h5file.attrs["Pruning duration (formatted)"] = utils.format_duration(self._pruning_end - self._pruning_start)
         return True
 
 # Only for tests
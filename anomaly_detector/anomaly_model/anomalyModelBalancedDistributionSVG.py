@@ -11,7 +11,8 @@ from scipy.spatial import distance
 from tqdm import tqdm
 
 from anomalyModelBalancedDistribution import AnomalyModelBalancedDistribution
-from common import utils, logger
+from anomalyModelSVG import mahalanobis_distances
+from common import utils, logger, MomentAccumulator
 
 class AnomalyModelBalancedDistributionSVG(AnomalyModelBalancedDistribution):
     """Anomaly model formed by a Balanced Distribution of feature vectors
@@ -20,6 +21,7 @@ class AnomalyModelBalancedDistributionSVG(AnomalyModelBalancedDistribution):
     def __init__(self, initial_normal_features=1000, threshold_learning=50, threshold_classification=5, pruning_parameter=0.5):
         AnomalyModelBalancedDistribution.__init__(self, initial_normal_features, threshold_learning, pruning_parameter)
         self._var       = None # Variance σ²
+        self._moments   = None # Incremental mean and variance (only used while learning)
 
     def _calculate_mean_and_covariance(self):
         """Calculate mean and inverse of covariance of the "normal" distribution"""
@@ -29,6 +31,30 @@ class AnomalyModelBalancedDistributionSVG(AnomalyModelBalancedDistribution):
         self._mean = np.mean(self.balanced_distribution["features"], axis=0, dtype=np.float64)  # Mean
         self._var = np.var(self.balanced_distribution["features"], axis=0, dtype=np.float64)    # Variance
     
+    def _initialize_learning(self, features):
+        """Initialize the incremental model with the initial "normal" features (N, D)"""
+        self._moments = MomentAccumulator().update(features)
+        self._mean = self._moments.mean
+        self._var = self._moments.var
+
+    def _learning_distances(self, features):
+        """Mahalanobis distances (N,) of features (N, D) to the current incremental model"""
+        return self.__mahalanobis_distance_batch__(features)
+
+    def _add_to_distribution(self, feature):
+        """Add a single feature vector (D,) to the incremental model (Welford update)"""
+        self._moments.update(feature)
+        self._mean = self._moments.mean
+        self._var = self._moments.var
+
+    def _pruning_distances(self, features):
+        """Mahalanobis distances (N,) of all the "normal" features (N, D) to the incremental model"""
+        return self.__mahalanobis_distance_batch__(features)
+
+    def _finish_learning(self):
+        """Free the incremental model"""
+        self._moments = None
+
     def __mahalanobis_distance__(self, patch):
         """Calculate the Mahalanobis distance between the input and the model"""
         assert not self._var is None and not self._mean is None, \
@@ -38,14 +64,17 @@ class AnomalyModelBalancedDistributionSVG(AnomalyModelBalancedDistribution):
         assert feature.shape == self._var.shape == self._mean.shape, \
             "Shapes don't match (x: %s, μ: %s, σ²: %s)" % (feature.shape, self._mean.shape, self._var.shape)
         
-        # TODO: This is a hack for collapsed SVGs. Should normally not happen
-        if not self._var.any(): # var contains only zeros
-            if (feature == self._mean).all():
-                return 0.0
-            else:
-                return np.nan
-
-        return np.sqrt(np.sum(np.divide((feature - self._mean) **2, self._var, out=np.zeros_like(self._var), where=self._var!=0)))
+        return mahalanobis_distances(feature, self._mean, self._var)
+
+    def __mahalanobis_distance_batch__(self, features):
+        """Calculate the Mahalanobis distances between a batch of features (N, D) and the model"""
+        assert not self._var is None and not self._mean is None, \
+            "You need to load a model before computing a Mahalanobis distance"
+
+        assert features.shape[-1:] == self._var.shape == self._mean.shape, \
+            "Shapes don't match (x: %s, μ: %s, σ²: %s)" % (features.shape, self._mean.shape, self._var.shape)
+        
+        return mahalanobis_distances(features, self._mean, self._var)
 
 # Only for tests
 if __name__ == "__main__":
@@ -12,13 +12,15 @@ from common import PatchArray, Visualize, utils, logger
 
 class AnomalyModelBase(object):
     
+    BATCH_SIZE = 8192 # Number of patches scored at once when calculating all Mahalanobis distances
+
     def __init__(self):
         self.NAME = self.__class__.__name__.replace("AnomalyModel", "")
         self.patches = None
     
     def __generate_model__(self, patches, silent=False):
         """Generate a model based on the features and metadata
-        
+
         Args:
             patches (PatchArray): Array of patches with features as extracted by a FeatureExtractor
 
@@ -26,14 +28,39 @@ class AnomalyModelBase(object):
             h5py.group that will be saved to the features file
         """
         raise NotImplementedError()
-        
+
+    def __generate_model_from_file__(self, filename, frames, chunk_size, silent=False):
+        """Generate the model chunk by chunk straight from the features in a HDF5 file
+        (optional, used by load_or_generate if a chunk size is given)
+
+        Args:
+            filename (str): HDF5 file containing features (see feature_extractor for details)
+            frames (array): Boolean array selecting the frames used for training
+            chunk_size (int): Number of frames read at once
+
+        Returns:
+            success (bool)
+        """
+        raise NotImplementedError()
+
     def __mahalanobis_distance__(self, patch):
         """Calculate the Mahalanobis distance between the input and the model"""
         raise NotImplementedError()
-        
+
+    def __mahalanobis_distance_batch__(self, features):
+        """Calculate the Mahalanobis distances between a batch of features and the model
+
+        Args:
+            features (np.array): Array of shape (N, D) with one feature vector per row
+
+        Returns:
+            Array of shape (N,) with the Mahalanobis distances
+        """
+        raise NotImplementedError()
+
     def classify(self, patch):
         """Classify a single feature based on the loaded model
-        
+
         Args:
             patch (np.record): A single patch (with feature)
 
@@ -59,13 +86,17 @@ class AnomalyModelBase(object):
     ########################
     
     def load_or_generate(self, patches=consts.FEATURES_FILE,
-                               load_patches=False, silent=False):
+                               load_patches=False, silent=False, chunk_size=None):
         """Load a model from file or generate it based on the features
-        
+
         Args:
             patches (str, PatchArray) : HDF5 file containing features (see feature_extractor for details)
+            chunk_size (int): Stream the features from file in chunks of chunk_size frames when generating
+                              the model (if supported, see __generate_model_from_file__) and when calculating
+                              the Mahalanobis distances (Default: None, use memory). The PatchArray does not
+                              need to contain the features then (PatchArray(filename, features=False)).
         """
-        
+
         # Load patches if necessary
         if isinstance(patches, basestring):
             if patches == "" or not os.path.exists(patches) or not os.path.isfile(patches):
@@ -78,7 +109,7 @@ class AnomalyModelBase(object):
 
             # Read file
             if not isinstance(self.patches, PatchArray):
-                patches = PatchArray(patches)
+                patches = PatchArray(patches, features=chunk_size is None)
         elif isinstance(patches, PatchArray):
             self.patches = patches
             # Try loading
@@ -87,7 +118,7 @@ class AnomalyModelBase(object):
                 return True
         else:
             raise ValueError("patches must be a path to a file or a PatchArray.")
-        
+
         assert patches.contains_features, "patches must contain features to calculate an anomaly model."
 
         self.patches = patches
@@ -97,7 +128,22 @@ class AnomalyModelBase(object):
         start = time.time()
 
         # Generate model
-        if self.__generate_model__(model_input, silent=silent) == False:
+        generated = None
+        if chunk_size is not None:
+            try:
+                generated = self.__generate_model_from_file__(patches.filename, patches.training_mask, chunk_size, silent=silent)
+            except NotImplementedError as e:
+                logger.warning("%s can not be generated from the file (%s), using the features in memory" % (self.NAME, str(e) or "not supported"))
+
+        if generated is None:
+            if not patches.features_loaded:
+                logger.warning("Loading the features of %s for %s" % (patches.filename, self.NAME))
+                patches = PatchArray(patches.filename, images_path=patches.images_path)
+                self.patches = patches
+                model_input = self.filter_training(patches)
+            generated = self.__generate_model__(model_input, silent=silent)
+
+        if generated == False:
             logger.info("Could not generate model.")
             return False
 
@@ -105,7 +151,7 @@ class AnomalyModelBase(object):
 
         self.save_to_file(model_input.size, start, end)
 
-        self.calculate_mahalanobis_distances()
+        self.calculate_mahalanobis_distances(chunk_size=chunk_size)
 
         return True
 
@@ -164,26 +210,107 @@ class AnomalyModelBase(object):
 
             return self.__load_model_from_file__(g)
     
-    def calculate_mahalanobis_distances(self):
-        """ Calculate all the Mahalanobis distances and save them to the file """
+    def _mahalanobis_distances(self, features, frames):
+        """Calculate the Mahalanobis distances of a block of frames
+
+        Args:
+            features (np.array): Features of the block with shape (n, h, w, D)
+            frames (slice): Frame indices of the block in self.patches
+
+        Returns:
+            Array of shape (n, h, w) with the Mahalanobis distances
+        """
+        try:
+            maha = self.__mahalanobis_distance_batch__(features.reshape(-1, features.shape[-1]))
+            return maha.reshape(features.shape[:-1])
+        except NotImplementedError:
+            # Fall back to one call per patch
+            assert self.patches.features_loaded, "%s needs the features of the PatchArray" % self.NAME
+            block = self.patches[frames]
+            maha = np.zeros(block.shape, dtype=np.float64)
+            for i in np.ndindex(block.shape):
+                maha[i] = self.__mahalanobis_distance__(block[i])
+            return maha
+
+    def calculate_mahalanobis_distances(self, chunk_size=None):
+        """ Calculate all the Mahalanobis distances and save them to the file
+
+        Args:
+            chunk_size (int): Read the features from the file in chunks of chunk_size frames instead
+                              of using the features of the PatchArray (eg. if they were not loaded).
+        """
         with h5py.File(self.patches.filename, "r+") as hf:
             g = hf.get(self.NAME)
 
             if g is None:
                 raise ValueError("The model needs to be saved first")
-            
-            maha = np.zeros(self.patches.shape, dtype=np.float64)
-            
-            for i in tqdm(np.ndindex(self.patches.shape), desc="Calculating mahalanobis distances", total=self.patches.size, file=sys.stderr):
-                maha[i] = self.__mahalanobis_distance__(self.patches[i])
 
-            no_anomaly = maha[self.patches.labels == 1]
-            anomaly = maha[self.patches.labels == 2]
+            if chunk_size is None:
+                # Score whole blocks of frames at once
+                frame_size = int(np.prod(self.patches.shape[1:]))
+                frames_per_batch = max(1, self.BATCH_SIZE // frame_size)
 
+                def _get_features(frames):
+                    return self.patches[frames].features
+            else:
+                features = hf["features"]
+                assert features.shape[0] == self.patches.shape[0], \
+                    "Streaming the features only works on the full PatchArray (%i != %i frames)" % (features.shape[0], self.patches.shape[0])
+                frames_per_batch = chunk_size
+
+                def _get_features(frames):
+                    f = features[frames]
+                    if f.ndim == 2:
+                        f = np.expand_dims(np.expand_dims(f, axis=1), axis=2)
+                    return f
+            
+            # Write to a temporary dataset that is only renamed when all distances are
+            # calculated, so an interrupted run does not look like a finished one (see is_in_file)
             if g.get("mahalanobis_distances") is not None: del g["mahalanobis_distances"]
-            m = g.create_dataset("mahalanobis_distances", data=maha)
-            m.attrs["max_no_anomaly"] = np.nanmax(no_anomaly) if no_anomaly.size > 0 else np.NaN
-            m.attrs["max_anomaly"]    = np.nanmax(anomaly) if anomaly.size > 0 else np.NaN
+            if g.get("mahalanobis_distances_incomplete") is not None: del g["mahalanobis_distances_incomplete"]
+            m = g.create_dataset("mahalanobis_distances_incomplete",
+                                 shape=self.patches.shape,
+                                 chunks=(min(frames_per_batch, self.patches.shape[0]),) + self.patches.shape[1:],
+                                 dtype=np.float64)
+
+            max_no_anomaly = np.NaN
+            max_anomaly    = np.NaN
+
+            # Joined from the frame metadata, so only get them once
+            labels = self.patches.labels
+
+            start = time.time()
+
+            with tqdm(desc="Calculating mahalanobis distances", total=self.patches.size, unit="patches", file=sys.stderr) as pbar:
+                for s in range(0, self.patches.shape[0], frames_per_batch):
+                    frames = slice(s, s + frames_per_batch)
+                    maha = self._mahalanobis_distances(_get_features(frames), frames)
+                    m[frames] = maha
+
+                    no_anomaly = maha[labels[frames] == 1]
+                    anomaly    = maha[labels[frames] == 2]
+                    if no_anomaly.size > 0: max_no_anomaly = np.fmax(max_no_anomaly, np.nanmax(no_anomaly))
+                    if anomaly.size > 0:    max_anomaly    = np.fmax(max_anomaly,    np.nanmax(anomaly))
+
+                    pbar.update(maha.size)
+
+            end = time.time()
+
+            g.move("mahalanobis_distances_incomplete", "mahalanobis_distances")
+            m = g["mahalanobis_distances"]
+
+            patches_per_second = self.patches.size / max(end - start, 1e-9)
+            logger.info("Calculated %i mahalanobis distances in %s (%.0f patches/s)" % (self.patches.size, utils.format_duration(end - start), patches_per_second))
+
+            m.attrs["max_no_anomaly"] = max_no_anomaly
+            m.attrs["max_anomaly"]    = max_anomaly
+            m.attrs["Start"] = start
+            m.attrs["End"] = end
+            m.attrs["Duration"] = end - start
+            m.attrs["Duration (formatted)"] = utils.format_duration(end - start)
+            m.attrs["Patches per second"] = patches_per_second
+            if chunk_size is not None:
+                m.attrs["Chunk size"] = chunk_size
 
             # hist1, bins = np.histogram(no_anomaly, bins="fd")
             # m.attrs["histogram_no_anomaly"] = hist1
@@ -201,7 +328,7 @@ class AnomalyModelBase(object):
 
         if "threshold" not in kwargs:
             kwargs["threshold"] = 60
-        
+
         if "patch_to_color_func" not in kwargs:
             def _default_patch_to_color(v, patch):
                 b = 0#100 if patch in self.normal_distribution else 0
@@ -225,5 +352,5 @@ class AnomalyModelBase(object):
 
         vis.create_trackbar("threshold", int(kwargs["threshold"]), 1000)
         vis.create_trackbar("show_thresh", 1, 1)
-        
+
         vis.show()
\ No newline at end of file
@@ -2,12 +2,38 @@
 
 import os
 
+import h5py
 import numpy as np
 # import tensorflow_probability as tfp
 from scipy.spatial import distance
 
 from anomalyModelBase import AnomalyModelBase
-from common import utils, logger
+from common import utils, logger, MomentAccumulator
+
+def mahalanobis_distances(features, mean, var):
+    """Calculate the Mahalanobis distances between feature vectors and single variate Gaussians
+
+    Args:
+        features (array): Feature vectors (..., D)
+        mean (array): Mean μ (D,) or one per feature vector (..., D)
+        var (array): Variance σ² (same shape as mean)
+
+    Returns:
+        np.ndarray of shape features.shape[:-1]
+    """
+    varI = np.divide(1.0, var, out=np.zeros_like(var), where=var!=0)
+    diff = np.subtract(features, mean, dtype=np.float64)
+    np.square(diff, out=diff)
+    if varI.ndim == 1:
+        dist = np.sqrt(diff.dot(varI))
+    else:
+        dist = np.sqrt(np.einsum("...i,...i->...", diff, varI))
+
+    # TODO: This is a hack for collapsed SVGs. Should normally not happen
+    collapsed = ~np.any(var, axis=-1)
+    if np.any(collapsed):
+        dist = np.where(collapsed, np.where(np.all(diff == 0, axis=-1), 0.0, np.nan), dist)
+    return dist
 
 class AnomalyModelSVG(AnomalyModelBase):
     """Anomaly model formed by a Single Variate Gaussian (SVG) with model parameters Θ_SVG = (μ,σ²)
@@ -33,41 +59,56 @@ class AnomalyModelSVG(AnomalyModelBase):
         assert feature.shape == self._var.shape == self._mean.shape, \
             "Shapes don't match (x: %s, μ: %s, σ²: %s)" % (feature.shape, self._mean.shape, self._var.shape)
         
-        # TODO: This is a hack for collapsed SVGs. Should normally not happen
-        if not self._var.any(): # var contains only zeros
-            if (feature == self._mean).all():
-                return 0.0
-            else:
-                return np.nan
-
-        res = np.sqrt(np.sum(np.divide((feature - self._mean) **2, self._var, out=np.zeros_like(self._var), where=self._var!=0)))
+        return mahalanobis_distances(feature, self._mean, self._var)
         # res2 = distance.mahalanobis(feature, self._mean, np.diag(self._varI))
-        return res
         
         ### scipy implementation is way slower
         # if self._varI is None:
         #     self._varI = np.linalg.inv(np.diag(self._var))
         # return distance.mahalanobis(feature, self._mean, self._varI)
 
+    def __mahalanobis_distance_batch__(self, features):
+        """Calculate the Mahalanobis distances between a batch of features (N, D) and the model"""
+        assert not self._var is None and not self._mean is None, \
+            "You need to load a model before computing a Mahalanobis distance"
+
+        assert features.shape[-1:] == self._var.shape == self._mean.shape, \
+            "Shapes don't match (x: %s, μ: %s, σ²: %s)" % (features.shape, self._mean.shape, self._var.shape)
+
+        return mahalanobis_distances(features, self._mean, self._var)
+
     def __generate_model__(self, patches, silent=False):
-        if not silent: logger.info("Generating SVG from %i feature vectors of length %i" % (len(patches.ravel()), patches.features.shape[-1]))
+        if not silent: logger.info("Generating SVG from %i feature vectors of length %i" % (patches.size, patches.features.shape[-1]))
 
         if not silent and patches.size == 1:
             logger.warning("Trying to generate SVG from a single value.")
 
-        # Get the variance
-        if not silent: logger.info("Calculating the variance")
-        self._var = patches.var()
-        # d = np.diag(self._var)
-        # self._varI = np.linalg.pinv(d)
-        # self._varI = np.divide(np.ones_like(self._var), self._var, out=np.zeros_like(self._var), where=self._var!=0)
-        # --> one variance per feature dimension
+        # Get mean and variance in a single pass
+        if not silent: logger.info("Calculating the mean and variance")
+        return self._set_moments(patches.moments())
+        # --> one mean and one variance per feature dimension
 
-        # Get the mean
-        if not silent: logger.info("Calculating the mean")
-        self._mean = patches.mean()
-        # --> one mean per feature dimension
+    def __generate_model_from_file__(self, filename, frames, chunk_size, silent=False):
+        """Generate the model chunk by chunk straight from the features in a HDF5 file
+        (Works for recordings that are larger than memory)"""
+        with h5py.File(filename, "r") as hf:
+            if frames is not None and len(frames) != hf["features"].shape[0]:
+                raise NotImplementedError("filtered PatchArray") # Only works on the full PatchArray, fall back to __generate_model__
+            if not silent: logger.info("Generating SVG from %s (chunk size: %i frames)" % (filename, chunk_size))
+            moments = MomentAccumulator().update_from_dataset(hf["features"], frames=frames, chunk_size=chunk_size)
 
+        if not silent and moments.count == 1:
+            logger.warning("Trying to generate SVG from a single value.")
+
+        return self._set_moments(moments)
+
+    def _set_moments(self, moments):
+        """Set the model parameters from a MomentAccumulator (eg. merged from parallel workers)"""
+        if moments.count == 0:
+            logger.warning("Can't generate a SVG from nothing!")
+            return False
+        self._var  = moments.var
+        self._mean = moments.mean
         return True
 
     def __load_model_from_file__(self, h5file):
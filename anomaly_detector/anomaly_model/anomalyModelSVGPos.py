@@ -13,6 +13,9 @@ class AnomalyModelSVGPos(AnomalyModelSVG):
         # Add location to features
         AnomalyModelSVG.__generate_model__(self, patches.add_location_as_feature_dimension(), silent=silent)
 
+    def __generate_model_from_file__(self, filename, frames, chunk_size, silent=False):
+        raise NotImplementedError("the locations are not in the features dataset")
+
 # Only for tests
 if __name__ == "__main__":
     model = AnomalyModelSVGPos()
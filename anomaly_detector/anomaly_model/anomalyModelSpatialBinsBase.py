@@ -7,9 +7,11 @@ import sys
 
 import h5py
 import numpy as np
+from scipy import sparse
 from tqdm import tqdm
 
 from anomalyModelBase import AnomalyModelBase
+from anomalyModelSVG import AnomalyModelSVG, mahalanobis_distances
 from common import utils, logger, PatchArray
 import consts
 
@@ -31,12 +33,19 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
         
         m = create_anomaly_model_func()
         self.NAME = "SpatialBin/%s/%s" % (m.__class__.__name__.replace("AnomalyModel", ""), self.KEY)
+
+        # SVGs of all bins can be calculated at once with a grouped reduction
+        self.SVG = type(m) is AnomalyModelSVG
+        self._bins     = None  # Flat indices of the bins with a model (M,)
+        self._bin_rows = None  # Row in _means and _vars of each bin (V * U,), -1 if there is no model
+        self._means    = None  # Means of the bins (M or V * U, D)
+        self._vars     = None  # Variances of the bins (M or V * U, D)
     
     def classify(self, patch, threshold=None):
         """The anomaly measure is defined as the Mahalanobis distance between a feature sample
         and the single variate Gaussian distribution along each dimension.
         """
-        model = self.models.flat[patch["bins_" + self.KEY]]
+        model = self.models.flat[self.patches.rasterizations[self.KEY].bins(patch.index)]
         if model is None:
             # logger.warning("No model available for this bin (%i, %i)" % (patch.bins.v, patch.bins.u))
             return 0 # Unknown
@@ -46,7 +55,7 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
     def __mahalanobis_distance__(self, patch):
         """Calculate the Mahalanobis distance between the input and the model"""
         
-        model = self.models.flat[patch["bins_" + self.KEY]]
+        model = self.models.flat[self.patches.rasterizations[self.KEY].bins(patch.index)]
         if np.all(model == None):
             # logger.warning("No model available for this bin (%i, %i)" % (patch.bins.v, patch.bins.u))
             return np.nan # TODO: What should we do?
@@ -56,6 +65,52 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
     def filter_training(self, patches):
         return patches
 
+    def _mahalanobis_distances(self, features, frames):
+        """Calculate the Mahalanobis distances of a block of frames.
+        For SVG sub-models all (patch, bin) distances are computed at once and averaged per patch.
+        """
+        if not self.SVG or self._means is None:
+            return AnomalyModelBase._mahalanobis_distances(self, features, frames)
+        
+        indptr, indices = self.patches.rasterizations[self.KEY].bins_of(self.patches[frames].index)
+        maha = self._svg_distances(features.reshape(-1, features.shape[-1]), indptr, indices)
+        return maha.reshape(features.shape[:-1])
+
+    def _svg_distances(self, features, indptr, indices):
+        """Mean Mahalanobis distance of each patch to the SVGs of its bins
+
+        Args:
+            features (np.array): Features of shape (N, D)
+            indptr (np.array): Offsets of the bins of each patch in indices (N + 1,)
+            indices (np.array): Flat bin indices
+
+        Returns:
+            Array of shape (N,) with the mean distances (NaN if there is no model for any of the bins)
+        """
+        N, D = features.shape
+
+        # (patch, row) pairs, ignoring bins without a model
+        pair_patches = np.repeat(np.arange(N), np.diff(indptr))
+        pair_rows = self._bin_rows[indices]
+        f = pair_rows >= 0
+        pair_patches = pair_patches[f]
+        pair_rows    = pair_rows[f]
+
+        sums = np.zeros(N, dtype=np.float64)
+
+        # Limit the size of the gathered (pairs, D) arrays
+        pairs_per_batch = max(1, self.BATCH_SIZE * 64 // D)
+        for s in range(0, pair_rows.size, pairs_per_batch):
+            patch = pair_patches[s:s + pairs_per_batch]
+            row   = pair_rows[s:s + pairs_per_batch]
+
+            dist = mahalanobis_distances(features[patch], self._means[row], self._vars[row])
+            sums += np.bincount(patch, weights=dist, minlength=N)
+        
+        # Segmented mean
+        counts = np.bincount(pair_patches, minlength=N)
+        return np.divide(sums, counts, out=np.full(N, np.nan), where=counts > 0)
+
     def __generate_model__(self, patches, silent=False):
         # Ensure locations are calculated
         assert patches.contains_features, "Can only compute patch locations if there are patches"
@@ -65,6 +120,9 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
         if not self.KEY in patches.contains_bins.keys() or not patches.contains_bins[self.KEY]:
             patches.calculate_rasterization(self.CELL_SIZE, self.FAKE)
         
+        if self.SVG:
+            return self._generate_svg_models(patches, silent=silent)
+
         patches_flat = patches.ravel()
         
         raster = patches.rasterizations[self.KEY]
@@ -75,7 +133,7 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
 
         with tqdm(desc="Generating models", total=self.models.size, file=sys.stderr) as pbar:
             for bin in np.ndindex(raster.shape):
-                indices = raster[bin]
+                indices = raster.patches(np.ravel_multi_index(bin, raster.shape))
 
                 if len(indices) > 0:
                     model_input = AnomalyModelBase.filter_training(self, patches_flat[indices])
@@ -89,6 +147,99 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
                 pbar.update()
         return True
     
+    def _generate_svg_models(self, patches, silent=False):
+        """Calculate the SVGs of all bins at once in a single pass over the features.
+        The rasterization is used as a sparse matrix (bins x patches) that sums the features
+        of each bin. The moments of every block of frames are merged like in MomentAccumulator.
+        """
+        raster = patches.rasterizations[self.KEY]
+        frame_size = int(np.prod(patches.shape[1:]))
+
+        # (bin, patch) pairs of the rasterization (sorted by patch)
+        pair_patches = np.repeat(np.arange(raster.num_patches), np.diff(raster.patch_indptr))
+        pair_bins    = raster.patch_indices
+
+        # Only use training patches
+        training = np.repeat(patches.training_mask, frame_size)
+        f = training[pair_patches]
+        pair_patches = pair_patches[f]
+        pair_bins    = pair_bins[f]
+
+        # Bins with at least one training patch get a model
+        self._bins, pair_rows = np.unique(pair_bins, return_inverse=True)
+
+        M = self._bins.size
+        D = patches.features.shape[-1]
+
+        if M == 0:
+            logger.warning("No training patches found")
+            return False
+
+        count = np.zeros(M, dtype=np.float64)
+        means = np.zeros((M, D), dtype=np.float64)  # Mean μ
+        m2    = np.zeros((M, D), dtype=np.float64)  # Sum of squared differences from the mean
+
+        frames_per_batch = max(1, self.BATCH_SIZE // frame_size)
+
+        with tqdm(desc="Generating models", total=patches.shape[0], file=sys.stderr) as pbar:
+            for s in range(0, patches.shape[0], frames_per_batch):
+                e = min(s + frames_per_batch, patches.shape[0])
+                
+                # Pairs of the patches in this block
+                a, b = np.searchsorted(pair_patches, [s * frame_size, e * frame_size])
+                if a < b:
+                    features = patches[s:e].features.reshape(-1, D)
+
+                    # Only the bins of this block
+                    rows, block_rows = np.unique(pair_rows[a:b], return_inverse=True)
+                    block_patches = pair_patches[a:b] - s * frame_size
+
+                    group = sparse.csr_matrix((np.ones(b - a), (block_rows, block_patches)),
+                                              shape=(rows.size, features.shape[0]))
+                    n = np.bincount(block_rows).astype(np.float64)
+                    block_means = group.dot(features) / n[:, np.newaxis]
+
+                    # Squared differences from the block means
+                    diff = features[block_patches] - block_means[block_rows]
+                    pairs = sparse.csr_matrix((np.ones(b - a), (block_rows, np.arange(b - a))),
+                                              shape=(rows.size, b - a))
+                    block_m2 = pairs.dot(np.square(diff, out=diff))
+
+                    # Merge with the moments of the previous blocks (Chan et al.)
+                    total = count[rows] + n
+                    delta = block_means - means[rows]
+                    means[rows] += delta * (n / total)[:, np.newaxis]
+                    m2[rows]    += block_m2 + delta ** 2 * (count[rows] * n / total)[:, np.newaxis]
+                    count[rows]  = total
+                pbar.update(e - s)
+
+        self._vars  = np.divide(m2, count[:, np.newaxis], out=m2) # Same as np.var (ddof=0)
+        self._means = means
+
+        self._bin_rows = np.full(raster.size, -1, dtype=np.int64)
+        self._bin_rows[self._bins] = np.arange(M)
+        self._create_svg_models(raster.shape)
+
+        if not silent: logger.info("Generated %i SVGs from %i feature vectors" % (M, count.sum()))
+        return True
+
+    def _create_svg_models(self, shape):
+        """Create the SVG of every bin with a model (only views on the dense arrays)"""
+        self.models = np.empty(shape=shape, dtype=object)
+        for bin in self._bins:
+            row = self._bin_rows[bin]
+            model = self.CREATE_ANOMALY_MODEL_FUNC()
+            model._mean = self._means[row]
+            model._var  = self._vars[row]
+            self.models.flat[bin] = model
+
+    def _load_dense(self, dataset):
+        """Memory-map a dense model tensor if possible, else read it"""
+        mapped = utils.h5_memmap(dataset)
+        if mapped is None:
+            return np.array(dataset)
+        return mapped
+
     def __load_model_from_file__(self, h5file):
         """Load a SVG model from file"""
         if not "Models shape" in h5file.attrs.keys() or \
@@ -98,6 +249,26 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
         
         self.CELL_SIZE = h5file.attrs["Cell size"]
         
+        if "mean" in h5file.keys() and "var" in h5file.keys() and "mask" in h5file.keys():
+            # Dense format
+            mask = np.array(h5file["mask"]).ravel()
+            D = h5file["mean"].shape[-1]
+
+            self._means = self._load_dense(h5file["mean"]).reshape(-1, D)
+            self._vars  = self._load_dense(h5file["var"]).reshape(-1, D)
+            self._bins  = np.flatnonzero(mask)
+            self._bin_rows = np.where(mask, np.arange(mask.size), -1)
+            self._create_svg_models(h5file.attrs["Models shape"])
+        else:
+            self._load_groups(h5file)
+        
+        if isinstance(self.patches, PatchArray):
+            self.patches.calculate_rasterization(self.CELL_SIZE)
+
+        return True
+
+    def _load_groups(self, h5file):
+        """Load the models from the old format with one group per bin"""
         self.models = np.empty(shape=h5file.attrs["Models shape"], dtype=object)
 
         with tqdm(desc="Loading models", total=h5file.attrs["Num models"], file=sys.stderr) as pbar:
@@ -110,17 +281,15 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
                     pbar.update()
 
             h5file.visititems(_add_model)
-        
-        if isinstance(self.patches, PatchArray):
-            self.patches.calculate_rasterization(self.CELL_SIZE)
-
-        return True
     
     def __save_model_to_file__(self, h5file):
         """Save the model to disk"""
         h5file.attrs["Cell size"] = self.CELL_SIZE
         h5file.attrs["Models shape"] = self.models.shape
         
+        if self.SVG and self._means is not None:
+            return self._save_dense(h5file)
+
         models_count = 0
         for v, u in tqdm(np.ndindex(self.models.shape), desc="Saving models", total=self.models.size, file=sys.stderr):
             model = self.models[v, u]
@@ -132,11 +301,35 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
                 models_count += 1
         h5file.attrs["Num models"] = models_count
         return True
+
+    def _save_dense(self, h5file):
+        """Save the SVGs of all bins as (V, U, D) mean and variance tensors and a (V, U) mask.
+        The tensors are stored contiguous, so they can be memory-mapped when loading."""
+        V, U = self.models.shape
+        D = self._means.shape[-1]
+
+        mask = (self._bin_rows >= 0).reshape(V, U)
+        h5file.create_dataset("mask", data=mask)
+        mean = h5file.create_dataset("mean", shape=(V, U, D), dtype=np.float64)
+        var  = h5file.create_dataset("var",  shape=(V, U, D), dtype=np.float64)
+
+        # Write one row of cells at a time
+        for v in tqdm(range(V), desc="Saving models", file=sys.stderr):
+            rows = self._bin_rows[v * U:(v + 1) * U]
+            row_mean = np.zeros((U, D), dtype=np.float64)
+            row_var  = np.zeros((U, D), dtype=np.float64)
+            row_mean[rows >= 0] = self._means[rows[rows >= 0]]
+            row_var[rows >= 0]  = self._vars[rows[rows >= 0]]
+            mean[v] = row_mean
+            var[v]  = row_var
+
+        h5file.attrs["Num models"] = np.count_nonzero(mask)
+        return True
     	
         
 # Only for tests
 if __name__ == "__main__":
-    from anomalyModelSVG import AnomalyModelSVG
+    from anomalyModelSVG import AnomalyModelSVG, mahalanobis_distances
     import consts
 
     patches = PatchArray(consts.FEATURES_FILE)
@@ -1,4 +1,7 @@
 from imageLocationUtility import ImageLocationUtility
+from momentAccumulator import MomentAccumulator
+from rasterization import Rasterization
+from lazyPatchArray import LazyPatchArray
 from patchArray import PatchArray, Patch
 import utils as utils
 from visualize import Visualize
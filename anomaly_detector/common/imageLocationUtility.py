@@ -80,16 +80,15 @@ class ImageLocationUtility(object):
         return np.stack(np.meshgrid(y, x), axis=2)
 
     def image_to_relative(self, image_coordinate, image_height=None, image_width=None):
-        """Transform an image coordinate to a location relative to the camera
+        """Transform image coordinates to locations relative to the camera
 
         Args:
-            image_coordinate (array): Array of shape (h, w, 2) or (2)
-                                      containing the image coordinate(s)
-            image_height (int): Needs to be specified when input is a single coordinate
-            image_width (int): Needs to be specified when input is a single coordinate
+            image_coordinate (array): Array of shape (..., 2) containing the image coordinate(s)
+            image_height (int): Needs to be specified unless input has shape (h, w, 2)
+            image_width (int): Needs to be specified unless input has shape (h, w, 2)
 
         Returns:
-            Array of shape (h, w, 2) or (2) containing the relative location(s)
+            Array of shape (..., 2) containing the relative location(s)
         """
         
         if len(image_coordinate.shape) == 3:
@@ -98,113 +97,129 @@ class ImageLocationUtility(object):
 
         # Get transformation matrix (3x3)
         P = self.get_image_transformation_matrix(image_height, image_width)
-
-        def _to_relative(p):
-            p = np.hstack([p, 1])           # Add one dimension so it matches P (3x3)
-            p_trans = P.dot(p)
-            p_trans = p_trans / p_trans[2]  # Normalize by third dimension
-            return p_trans[:-1]             # Return only the first two dimensions
-
-        if image_coordinate.ndim > 1:
-            return np.apply_along_axis(_to_relative, -1, image_coordinate)
-        elif image_coordinate.shape == (2,):
-            return _to_relative(image_coordinate)
-        else:
-            raise ValueError("Input has to be a an array of shape (h, w, 2) or (2,)")
+        return self._transform(P, image_coordinate)
 
     def relative_to_image(self, relative_location, image_height, image_width):
-        """Transform a location relative to the camera to an image coordinate
+        """Transform locations relative to the camera to image coordinates
 
         Args:
-            relative_location (array): Array of shape (h, w, 2) or (2)
-                                       containing the location(s)
-                                       relative to the camera
+            relative_location (array): Array of shape (..., 2) containing the
+                                       location(s) relative to the camera
             image_height (int): Image height
             image_width (int): Image width
 
         Returns:
-            Array of shape (h, w, 2) or (2) containing the image coordinate(s)
+            Array of shape (..., 2) containing the image coordinate(s)
         """
         
         # Get inverse transformation matrix (3x3)
         P_inv = self.get_inverse_image_transformation_matrix(image_height, image_width)
+        return self._transform(P_inv, relative_location)
 
-        def _to_image(p):
-            p = np.hstack([p, 1])           # Add one dimension so it matches P (3x3)
-            p_trans = P_inv.dot(p)
-            p_trans = p_trans / p_trans[2]  # Normalize by third dimension
-            return p_trans[:-1]             # Return only the first two dimensions
+    def relative_to_absolute(self, relative_location, camera_location):
+        """Transform relative locations to absolute locations
 
-        if relative_location.ndim > 1:
-            return np.apply_along_axis(_to_image, -1, relative_location)
-        elif relative_location.shape == (2,):
-            return _to_image(relative_location)
-        else:
-            raise ValueError("Input has to be a an array of shape (h, w, 2) or (2,)")
+        Args:
+            relative_location (array): Array of shape (..., 2) containing the
+                                       location(s) relative to the camera
+            camera_location (array): Structured array with the camera location
+                                     or the camera locations (N,) of multiple frames
 
-    def relative_to_absolute(self, relative_location, camera_location):
-        """Transform a relative location to an absolute location
+        Returns:
+            Array of shape (..., 2) or (N, ..., 2) containing the absolute location(s)
+        """
+        return self._transform(self.get_camera_matrix(camera_location), relative_location)
+
+    def absolute_to_relative(self, absolute_location, camera_location):
+        """Transform absolute locations to locations relative to the camera
 
         Args:
-            relative_location (array): Array of shape (h, w, 2) or (2,)
-                                       containing the location(s)
-                                       relative to the camera
+            absolute_location (array): Array of shape (..., 2) containing the absolute location(s)
             camera_location (array): Structured array with the camera location
+                                     or the camera locations (N,) of multiple frames
 
         Returns:
-            Array of shape (h, w, 2) or (2,) containing the absolute location(s)
+            Array of shape (..., 2) or (N, ..., 2) containing the
+            location(s) relative to the camera
         """
-        camera_translation = np.array((camera_location["translation"]["y"],
-                                       camera_location["translation"]["x"]))
-        camera_rotation_z  = camera_location["rotation"]["z"]
-        
-        # Construct an inverse 2D rotation matrix
-        s = np.sin(-camera_rotation_z + np.pi / 2.)
-        c = np.cos(-camera_rotation_z + np.pi / 2.)
+        return self._transform(self.get_camera_matrix(camera_location, inverse=True), absolute_location)
 
-        R = np.array([[ c, -s],
-                      [ s, c]])
+    def absolute_to_image(self, absolute_location, camera_location, image_height, image_width):
+        """Transform absolute locations to image coordinates
+        (same as absolute_to_relative followed by relative_to_image, but with a single matrix)
 
-        def _to_absolute(p):
-            return camera_translation + R.dot(p)
-        
-        if relative_location.ndim > 1:
-            return np.apply_along_axis(_to_absolute, -1, relative_location)
-        elif relative_location.shape == (2,):
-            return _to_absolute(relative_location)
-        else:
-            raise ValueError("Input has to be a an array of shape (h, w, 2) or (2,)")
+        Args:
+            absolute_location (array): Array of shape (..., 2) containing the absolute location(s)
+            camera_location (array): Structured array with the camera location
+                                     or the camera locations (N,) of multiple frames
+            image_height (int): Image height
+            image_width (int): Image width
 
-    def absolute_to_relative(self, absolute_location, camera_location):
-        """Transform an absolute location to a relative location
+        Returns:
+            Array of shape (..., 2) or (N, ..., 2) containing the image coordinate(s)
+        """
+        P_inv = self.get_inverse_image_transformation_matrix(image_height, image_width)
+        return self._transform(np.matmul(P_inv, self.get_camera_matrix(camera_location, inverse=True)), absolute_location)
+
+    def get_camera_matrix(self, camera_location, inverse=False):
+        """Calculate the homogeneous matrix that will transform relative
+        locations to absolute locations (or the other way around)
 
         Args:
-            absolute_location (array): Array of shape (h, w, 2) or (2,)
-                                       containing the absolute location(s)
             camera_location (array): Structured array with the camera location
+                                     or the camera locations (N,) of multiple frames
+            inverse (bool): Transform absolute to relative locations instead
 
         Returns:
-            Array of shape (h, w, 2) or (2,) containing the
-            location(s) relative to the camera
+            Matrix of shape (3, 3) or (N, 3, 3)
         """
-        camera_translation = np.array((camera_location["translation"]["y"],
-                                       camera_location["translation"]["x"]))
-        camera_rotation_z  = camera_location["rotation"]["z"]
+        translation_y = np.asarray(camera_location["translation"]["y"], dtype=np.float64)
+        translation_x = np.asarray(camera_location["translation"]["x"], dtype=np.float64)
+        rotation_z    = np.asarray(camera_location["rotation"]["z"], dtype=np.float64)
         
-        # Construct an inverse 2D rotation matrix
-        s = np.sin(-camera_rotation_z + np.pi / 2.)
-        c = np.cos(-camera_rotation_z + np.pi / 2.)
+        # 2D rotation matrix
+        s = np.sin(-rotation_z + np.pi / 2.)
+        c = np.cos(-rotation_z + np.pi / 2.)
+
+        M = np.zeros(rotation_z.shape + (3, 3), dtype=np.float64)
+        M[..., 2, 2] = 1
+
+        if inverse:
+            # R is orthogonal --> transpose and inverse are the same
+            M[..., 0, 0] =  c
+            M[..., 0, 1] =  s
+            M[..., 1, 0] = -s
+            M[..., 1, 1] =  c
+            M[..., 0, 2] = -(c * translation_y + s * translation_x)
+            M[..., 1, 2] =   s * translation_y - c * translation_x
+        else:
+            M[..., 0, 0] =  c
+            M[..., 0, 1] = -s
+            M[..., 1, 0] =  s
+            M[..., 1, 1] =  c
+            M[..., 0, 2] = translation_y
+            M[..., 1, 2] = translation_x
+        return M
 
-        # R is orthogonal --> transpose and inverse are the same
-        R_inv = np.array([[ c, s],
-                          [-s, c]])
+    def _transform(self, M, points):
+        """Apply homogeneous transformation matrices to points
 
-        def _to_relative(p):
-            return R_inv.dot(p - camera_translation)
+        Args:
+            M (array): Matrix of shape (3, 3) or (N, 3, 3)
+            points (array): Array of shape (..., 2)
 
-        if absolute_location.ndim > 1:
-            return np.apply_along_axis(_to_relative, -1, absolute_location)
-        elif absolute_location.shape == (2,):
-            return _to_relative(absolute_location)
-        else:
-            raise ValueError("Input has to be a an array of shape (h, w, 2) or (2,)")
\ No newline at end of file
+        Returns:
+            Array of shape (..., 2) or (N, ..., 2)
+        """
+        points = np.asarray(points, dtype=np.float64)
+        if points.ndim == 0 or points.shape[-1] != 2:
+            raise ValueError("Input has to be an array of shape (..., 2)")
+
+        shape = points.shape
+
+        # [y, x, 1] * M^T as one matmul (P, 3) or (N, P, 3)
+        res = np.matmul(points.reshape(-1, 2), np.swapaxes(M[..., :, :2], -1, -2))
+        res += M[..., np.newaxis, :, 2]
+        res[..., :2] /= res[..., 2:]        # Normalize by third dimension
+
+        return res[..., :2].reshape(M.shape[:-2] + shape)
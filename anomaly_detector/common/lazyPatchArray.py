@@ -0,0 +1,304 @@
+import os
+import time
+
+import numpy as np
+import h5py
+
+from common import utils, logger, Rasterization
+import consts
+
+class LazyPatchArray(object):
+    """Read-only, column oriented access to a features file.
+
+    Every field is a separate array that is only read when it is accessed for
+    the first time. Contiguous datasets are memory-mapped, all others are read
+    from the HDF5 file and per frame metadata is broadcast without copying.
+    Indexing does not read anything, the index is applied when a column is read.
+
+    This is not a PatchArray: There are no filter views (training, validation, ...)
+    and the anomaly models, metrics and Visualize need a regular PatchArray.
+    It is meant for reading a few columns of large files (eg. in analysis scripts).
+
+    Usage:
+        patches = PatchArray(filename, lazy=True)
+        patches[patches.labels == 2].get_mahalanobis_distances("SVG")
+    """
+
+    def __init__(self, filename, images_path=None, cache=False):
+        """Opens a features file without reading the patches.
+
+        Args:
+            filename (str): Features file (*.h5)
+            images_path (str): Directory with the metadata_cache.h5 (Default: consts.IMAGES_PATH)
+            cache (bool): Memory-map the columns from the cache next to the file
+                          if there is a valid one (see utils.save_cache)
+        """
+        if images_path is None: images_path = consts.IMAGES_PATH
+
+        s = time.time()
+
+        self.filename    = filename
+        self.images_path = images_path
+
+        self._hf = h5py.File(filename, "r")
+        self._metadata_hf = h5py.File(os.path.join(images_path, "metadata_cache.h5"), "r")
+
+        if not "features" in self._hf.keys():
+            raise ValueError("%s does not contain features." % filename)
+
+        self.receptive_field = self._hf.attrs.get("Receptive field", None)
+        self.image_size      = self._hf.attrs.get("Image size", None)
+
+        features = self._hf["features"]
+        if features.ndim == 2:
+            self._shape = (features.shape[0], 1, 1)
+        else:
+            self._shape = features.shape[:-1]
+
+        self._index = tuple()   # Indices applied to every column (in order)
+        self._cache = dict()    # Columns that were already read
+        self._sources = dict()  # Functions returning the full (unindexed) columns
+        self._rasterizations = None
+
+        # Match the metadata to the features (see PatchArray.__new__)
+        metadata_times = np.array(self._metadata_hf["times"])
+        feature_times  = np.array(self._hf["times"])
+        common_times, metadata_indices, feature_indices = np.intersect1d(metadata_times, feature_times, assume_unique=True, return_indices=True)
+        assert np.all(feature_indices == np.arange(len(feature_indices))), "Oops?"
+        if common_times.shape == metadata_times.shape and np.all(metadata_indices == np.arange(len(metadata_indices))):
+            metadata_indices = None
+
+        def _metadata(dataset):
+            def _load():
+                m = np.array(dataset)
+                if metadata_indices is not None:
+                    m = m[metadata_indices]
+                m = m.reshape((m.shape[0], 1, 1) + m.shape[1:])
+                return np.broadcast_to(m, self._shape + m.shape[3:])
+            return _load
+
+        def _add_metadata(name, dataset):
+            if isinstance(dataset, h5py.Dataset):
+                self._sources[name] = _metadata(dataset)
+
+        self._metadata_hf.visititems(_add_metadata)
+
+        if len(self._sources) == 0:
+            raise ValueError("There should be at least a bit of metadata!")
+
+        self._sources["changed"] = lambda: np.broadcast_to(np.zeros((), dtype=np.bool_), self._shape)
+
+        # Patch datasets
+        location_type = [("tl", [("y", np.float32), ("x", np.float32)]),
+                         ("tr", [("y", np.float32), ("x", np.float32)]),
+                         ("br", [("y", np.float32), ("x", np.float32)]),
+                         ("bl", [("y", np.float32), ("x", np.float32)])]
+
+        self.contains_features     = True
+        self.contains_locations    = "locations" in self._hf.keys() or "fake_locations" in self._hf.keys()
+        self.contains_patch_labels = "patch_labels" in self._hf.keys()
+
+        self._sources["features"] = self._features
+        for name, dtype in (("locations", location_type), ("fake_locations", location_type), ("patch_labels", np.uint8)):
+            self._sources[name] = self._dataset_or_zeros(name, dtype)
+
+        if not self.contains_patch_labels:
+            self._sources["patch_labels_values"] = lambda: np.zeros(self._shape)
+
+        # Mahalanobis distances of all models
+        self._mahalanobis_distances = list()
+
+        def _add_mahalanobis_distances(name, dataset):
+            if isinstance(dataset, h5py.Dataset) and name.endswith("/mahalanobis_distances"):
+                self._mahalanobis_distances.append(name)
+
+        self._hf.visititems(_add_mahalanobis_distances)
+
+        self.contains_mahalanobis_distances = len(self._mahalanobis_distances) > 0
+        if self.contains_mahalanobis_distances:
+            self._sources["mahalanobis_distances"] = self._load_mahalanobis_distances
+            self._sources["mahalanobis_distances_filtered"] = lambda: np.zeros(self._shape, dtype=np.float64)
+
+        # Flat indices (eg. to look up the bins of a patch)
+        self._sources["index"] = lambda: np.arange(np.prod(self._shape), dtype=np.uint32).reshape(self._shape)
+
+        # The fields of the cache (memory-mapped) replace the HDF5 datasets
+        if cache:
+            cached = utils.load_cache(filename)
+            if cached is None:
+                logger.info("No valid cache for %s" % filename)
+            else:
+                for name in cached.dtype.names:
+                    self._sources[name] = (lambda n: lambda: cached[n])(name)
+
+        logger.info("Opening %s (lazy): %f" % (filename, time.time() - s))
+
+    def _features(self):
+        features = self._hf["features"]
+        mapped = utils.h5_memmap(features)
+        if mapped is None:
+            logger.warning("The features in %s are chunked or compressed and can not be memory-mapped, "
+                           "reading them instead (extract them with chunk_bytes=0 to map them)" % self.filename)
+        if features.ndim == 2:
+            if mapped is None:
+                mapped = np.array(features)
+            return mapped.reshape((features.shape[0], 1, 1, features.shape[1]))
+        return features if mapped is None else mapped
+
+    def _dataset_or_zeros(self, name, dtype):
+        def _load():
+            if name in self._hf.keys():
+                mapped = utils.h5_memmap(self._hf[name])
+                return self._hf[name] if mapped is None else mapped
+            return np.zeros(self._shape, dtype=dtype)
+        return _load
+
+    def _load_mahalanobis_distances(self):
+        arrays = list()
+        for name in self._mahalanobis_distances:
+            m = np.array(self._hf[name])
+            m[np.isnan(m)] = -1
+            arrays.append(m)
+        t = [(name.replace("/mahalanobis_distances", ""), m.dtype) for name, m in zip(self._mahalanobis_distances, arrays)]
+        return np.rec.fromarrays(arrays, dtype=t)
+
+    def _read(self, name):
+        """Read a column and apply the indices"""
+        return self._apply_index(self._sources[name]())
+
+    def _apply_index(self, data):
+        """Apply the indices to a column (HDF5 datasets are read here)"""
+        index = self._index
+
+        if isinstance(data, h5py.Dataset):
+            # Let HDF5 only read the selected frames if possible
+            if len(index) > 0 and _is_simple_index(index[0]):
+                data, index = data[index[0]], index[1:]
+            else:
+                data = data[()]
+
+        for i in index:
+            data = data[i]
+        return data
+
+    ################
+    #   Columns    #
+    ################
+
+    @property
+    def names(self):
+        """Names of all columns"""
+        return tuple(self._sources.keys())
+
+    @property
+    def shape(self):
+        dummy = np.broadcast_to(np.zeros((), dtype=np.bool_), self._shape)
+        for i in self._index:
+            dummy = dummy[i]
+        return dummy.shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getattr__(self, name):
+        # Only called if there is no regular attribute with this name
+        if name.startswith("_") or not name in self._sources:
+            raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
+        if not name in self._cache:
+            self._cache[name] = self._read(name)
+        return self._cache[name]
+
+    def __getitem__(self, indx):
+        if isinstance(indx, str):
+            return self.__getattr__(indx)
+
+        if isinstance(indx, LazyPatchArray):
+            raise IndexError("Can not index with a LazyPatchArray")
+
+        view = object.__new__(LazyPatchArray)
+        view.__dict__.update(self.__dict__)
+        view._index = self._index + (indx,)
+        view._cache = dict()
+        return view
+
+    def get_mahalanobis_distances(self, model):
+        """Mahalanobis distances of a single model (only this model's dataset is read,
+        the mahalanobis_distances column reads the distances of all models)
+
+        Args:
+            model (str): Name of the anomaly model
+
+        Returns:
+            np.ndarray (NaN replaced by -1, like in PatchArray)
+        """
+        name = model + "/mahalanobis_distances"
+        if not name in self._mahalanobis_distances:
+            raise KeyError("%s does not contain mahalanobis distances of %s" % (self.filename, model))
+        if not name in self._cache:
+            m = np.array(self._apply_index(self._hf[name]), dtype=np.float64)
+            m[np.isnan(m)] = -1
+            self._cache[name] = m
+        return self._cache[name]
+
+    def load(self, names=None):
+        """Read columns into a (regular) record array
+
+        Args:
+            names (list): Names of the columns (Default: all columns)
+
+        Returns:
+            np.recarray
+        """
+        if names is None:
+            names = self.names
+        arrays = [self[n] for n in names]
+        t = [(n, a.dtype, a.shape[self.ndim:]) for n, a in zip(names, arrays)]
+        return np.rec.fromarrays(arrays, dtype=t)
+
+    ####################
+    #  Rasterizations  #
+    ####################
+
+    @property
+    def rasterizations(self):
+        """Rasterizations in the file (only loaded on first access)"""
+        if self._rasterizations is None:
+            self._rasterizations = dict()
+            for k in ("fake_0.20", "fake_0.50", "fake_2.00", "0.20", "0.50", "2.00"):
+                self._rasterizations[k] = Rasterization.load(self._hf, k)
+        return self._rasterizations
+
+    @property
+    def contains_bins(self):
+        return {k: r is not None and r.num_patches == np.prod(self._shape) for k, r in self.rasterizations.items()}
+
+    def close(self):
+        """Close the files (columns that are not memory-mapped can not be read anymore)"""
+        self._hf.close()
+        self._metadata_hf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _is_simple_index(indx):
+    """Check if h5py can apply an index directly (integers and slices with a positive step)"""
+    if not isinstance(indx, tuple):
+        indx = (indx,)
+    for i in indx:
+        if isinstance(i, slice):
+            if i.step is not None and i.step < 1:
+                return False
+        elif not isinstance(i, (int, np.integer)):
+            return False
+    return True
@@ -0,0 +1,100 @@
+import numpy as np
+
+class MomentAccumulator(object):
+    """Single pass accumulator for the mean and variance of feature vectors.
+    Partial results (eg. of chunks or parallel workers) can be merged.
+    Reference: Chan et al., "Updating Formulae and a Pairwise Algorithm for Computing Sample Variances"
+    """
+    def __init__(self):
+        self.count = 0
+        self._mean = None   # Mean μ
+        self._m2   = None   # Sum of squared differences from the mean
+
+    mean = property(lambda self: self._mean)
+    var  = property(lambda self: self._m2 / self.count if self.count > 0 else None) # Same as np.var (ddof=0)
+
+    def update(self, features):
+        """Add a batch of features
+
+        Args:
+            features (array): Array of shape (N, D) or (D,) containing the feature vector(s)
+
+        Returns:
+            self
+        """
+        features = np.asarray(features)
+        features = features.reshape(-1, features.shape[-1])
+
+        n = features.shape[0]
+        if n == 0:
+            return self
+
+        batch_mean = np.mean(features, axis=0, dtype=np.float64)
+        diff = features - batch_mean
+        batch_m2 = np.einsum("ij,ij->j", diff, diff)
+
+        return self._combine(n, batch_mean, batch_m2)
+
+    def merge(self, other):
+        """Merge the moments of another accumulator into this one
+
+        Args:
+            other (MomentAccumulator): Accumulator (eg. of another chunk or worker)
+
+        Returns:
+            self
+        """
+        return self._combine(other.count, other._mean, other._m2)
+
+    def update_from_dataset(self, dataset, frames=None, chunk_size=64, start=0, stop=None):
+        """Add the features of a dataset chunk by chunk along the first (time) axis.
+        Only one chunk is in memory at a time, so this also works for HDF5 datasets
+        that are larger than memory.
+
+        Args:
+            dataset (h5py.Dataset, array): Features of shape (n, ..., D)
+            frames (array): Boolean array of shape (n,) selecting the frames to use (Default: all frames)
+            chunk_size (int): Number of frames read at once
+            start (int): First frame (eg. of a parallel worker)
+            stop (int): Last frame (exclusive, Default: all frames)
+
+        Returns:
+            self
+        """
+        if stop is None:
+            stop = dataset.shape[0]
+
+        for s in range(start, stop, chunk_size):
+            e = min(s + chunk_size, stop)
+
+            if frames is not None:
+                f = frames[s:e]
+                if not np.any(f):
+                    continue
+                if np.all(f):
+                    f = None
+
+            chunk = dataset[s:e]
+            if frames is not None and f is not None:
+                chunk = chunk[f]
+
+            self.update(chunk)
+        return self
+
+    def _combine(self, n, mean, m2):
+        if n == 0:
+            return self
+
+        if self.count == 0:
+            self.count = n
+            self._mean = np.array(mean, dtype=np.float64)
+            self._m2   = np.array(m2, dtype=np.float64)
+            return self
+
+        total = self.count + n
+        delta = mean - self._mean
+
+        self._mean += delta * (n / float(total))
+        self._m2   += m2 + delta ** 2 * (self.count * n / float(total))
+        self.count  = total
+        return self
@@ -17,18 +17,13 @@ import matplotlib.pyplot as plt
 import cv2
 from skimage.transform import resize
 
-from shapely.strtree import STRtree
-from shapely.geometry import Polygon, box
-from shapely.prepared import prep
-
 from scipy.ndimage.morphology import generate_binary_structure, grey_erosion, grey_dilation
 from sklearn import metrics
 from sklearn.manifold import TSNE
 import seaborn as sns
 import pandas as pd
-from joblib import Parallel, delayed
 
-from common import utils, logger, ImageLocationUtility
+from common import utils, logger, ImageLocationUtility, MomentAccumulator, Rasterization, LazyPatchArray
 import consts
 
 class Patch(np.record):
@@ -42,11 +37,32 @@ class Patch(np.record):
         if images_path is None: images_path = consts.IMAGES_PATH
         return os.path.join(images_path, "%i.jpg" % self.times)
 
+    def _is_frame_metadata(self, attr):
+        frame_metadata = self.__dict__.get("_frame_metadata", None)
+        return frame_metadata is not None and attr in frame_metadata.dtype.names and attr not in self.dtype.names
+
+    def __getattr__(self, attr):
+        # Only called if there is no field or attribute with this name
+        if self._is_frame_metadata(attr):
+            return self._frame_metadata[attr][self.index // self._frame_size]
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, attr))
+
+    def __getitem__(self, indx):
+        if isinstance(indx, str) and self._is_frame_metadata(indx):
+            return self.__getattr__(indx)
+        return np.record.__getitem__(self, indx)
+
     def __setattr__(self, attr, val):
-        if attr in self.dtype.names:
+        if self._is_frame_metadata(attr):
+            # The metadata is stored once per frame (see PatchArray.frame_metadata)
+            frame = self.index // self._frame_size
+            if not np.all(self._frame_metadata[attr][frame] == val): # Check if any value changed
+                self._frame_metadata[attr][frame] = val
+                if attr != "changed":
+                    self._frame_metadata["changed"][frame] = True
+        elif attr in self.dtype.names:
             old_val = self.__getattribute__(attr)
             if not np.all(old_val == val): # Check if any value changed
-                np.record.__setattr__(self, "changed", True)
                 np.record.__setattr__(self, attr, val)
         else:
             np.record.__setattr__(self, attr, val)
@@ -56,6 +72,9 @@ class PatchArray(np.recarray):
     
     __metadata_attrs__ = list()
 
+    # Receptive field tables (h, w, 4, 2) by (receptive field, image size, (h, w), fake)
+    __receptive_fields__ = dict()
+
     root = None
 
     def __new__(cls, filename=None, metadata_filename=None, **kwargs):
@@ -63,16 +82,28 @@ class PatchArray(np.recarray):
         
         Args:
             filename (str): filename to read
+            lazy (bool): Return a LazyPatchArray, that only reads the columns that are accessed
+                         (read-only column access, not usable with the anomaly models or Visualize)
+            images_path (str): Directory with the metadata_cache.h5
+            cache (bool): Memory-map the patches from (or create) a cache next to the file
+            features (bool): Load the features (Default: True). Without them (features_loaded is False)
+                             the PatchArray only holds the locations, labels and metadata, the anomaly
+                             models can then stream the features from the file (see load_or_generate)
 
         Returns:
             A new PatchArray
         """
+        if kwargs.get("lazy", False):
+            return LazyPatchArray(filename, images_path=kwargs.get("images_path", consts.IMAGES_PATH), cache=kwargs.get("cache", False))
+
         if cls.root is not None:
             logger.warning("There is already a root PatchArray loaded.")
         
         logger.info("Reading metadata and features from: %s" % filename)
 
         images_path = kwargs.get("images_path", consts.IMAGES_PATH)
+        load_features = kwargs.get("features", True)
+        use_cache = kwargs.get("cache", False) and load_features
         
         filename_metadata = os.path.join(images_path, "metadata_cache.h5")
         metadata = dict()
@@ -125,6 +156,8 @@ class PatchArray(np.recarray):
                 assert np.all(feature_times[feature_indices] == metadata["times"]), "Something went wrong"
                 assert np.all(feature_indices == np.arange(len(feature_indices))), "Oops?"
 
+                patches = cls._load_cache(filename) if use_cache else None
+
                 patches_dict = dict()
                 mahalanobis_dict = dict()
 
@@ -133,23 +166,35 @@ class PatchArray(np.recarray):
                 def _add(x, y):
                     if not isinstance(y, h5py.Dataset):
                         return
-                    if x in add or x.startswith("bins"):
+                    if x in add:
                         patches_dict[x] = y
                     elif x.endswith("/mahalanobis_distances"):
                         n = x.replace("/mahalanobis_distances", "")
-                        mahalanobis_dict[n] = numpy.array(y)
-                        mahalanobis_dict[n][np.isnan(mahalanobis_dict[n])] = -1
+                        mahalanobis_dict[n] = y
 
                 hf.visititems(_add)
 
-                if "features" in patches_dict.keys():
-                    contains_features = True
-                    if patches_dict["features"].ndim == 2:
-                        patches_dict["features"] = np.expand_dims(np.expand_dims(patches_dict["features"], axis=1), axis=2)
-                else:
+                if not "features" in patches_dict.keys():
                     raise ValueError("%s does not contain features." % filename)
 
                 locations_shape = patches_dict["features"].shape[:-1]
+                if len(locations_shape) == 1:
+                    locations_shape = locations_shape + (1, 1)
+
+                contains_features = True
+                if not load_features:
+                    del patches_dict["features"]
+                else:
+                    if patches_dict["features"].ndim == 2 and patches is None:
+                        patches_dict["features"] = np.expand_dims(np.expand_dims(patches_dict["features"], axis=1), axis=2)
+
+                # Receptive field tables stored when the locations were calculated
+                for fake in (False, True):
+                    name = cls._receptive_fields_dataset(fake)
+                    table = np.array(hf[name]) if name in hf.keys() else None
+                    if table is not None and table.shape == locations_shape[1:] + (4, 2):
+                        table.flags.writeable = False
+                        cls.__receptive_fields__[cls._receptive_fields_key(receptive_field, image_size, locations_shape[1:], fake)] = table
 
                 if "locations" in patches_dict.keys():
                     contains_locations = True
@@ -175,40 +220,44 @@ class PatchArray(np.recarray):
 
                 if len(mahalanobis_dict) > 0:
                     contains_mahalanobis_distances = True
-                    t = [(x, mahalanobis_dict[x].dtype) for x in mahalanobis_dict]
-                    patches_dict["mahalanobis_distances"] = np.rec.fromarrays(mahalanobis_dict.values(), dtype=t)
-                    patches_dict["mahalanobis_distances_filtered"] = np.zeros(locations_shape, dtype=np.float64)
+                    if patches is None:
+                        for n, m in mahalanobis_dict.items():
+                            mahalanobis_dict[n] = numpy.array(m)
+                            mahalanobis_dict[n][np.isnan(mahalanobis_dict[n])] = -1
+                        t = [(x, mahalanobis_dict[x].dtype) for x in mahalanobis_dict]
+                        patches_dict["mahalanobis_distances"] = np.rec.fromarrays(mahalanobis_dict.values(), dtype=t)
+                        patches_dict["mahalanobis_distances_filtered"] = np.zeros(locations_shape, dtype=np.float64)
                 
                 for k in contains_bins.keys():
-                    if ("bins_" + k) in patches_dict.keys():
-                        contains_bins[k] = True
-                        rasterizations[k] = np.array(hf["rasterization_" + k])
-                    else:
-                        contains_bins[k] = False
-                        patches_dict["bins_" + k] = np.zeros(locations_shape, dtype=object)
-
-                # Broadcast metadata to the correct shape
-                if patches_dict["features"].shape[1:-1] != ():
-                    for n, m in metadata.items():
-                        patches_dict[n] = np.moveaxis(np.broadcast_to(m, patches_dict["features"].shape[1:-1] + (m.size,)), -1, 0)
+                    rasterizations[k] = Rasterization.load(hf, k)
+                    # Only a part of the patches is rasterized if frames were appended
+                    contains_bins[k] = rasterizations[k] is not None and rasterizations[k].num_patches == np.prod(locations_shape)
+
+                if patches is None:
+                    # Add flat indices (eg. to look up the bins or the frame of a patch)
+                    patches_dict["index"] = np.arange(np.prod(locations_shape), dtype=np.uint32).reshape(locations_shape)
 
-                # Add indices as metadata
-                # patches_dict["index"] = np.mgrid[0:locations_shape[0], 0:locations_shape[1], 0:locations_shape[2]]
+                    # Create type
+                    t = [(x, patches_dict[x].dtype, patches_dict[x].shape[len(locations_shape):]) for x in patches_dict]
 
-                # Create type
-                t = [(x, patches_dict[x].dtype, patches_dict[x].shape[patches_dict["features"].ndim - 1:]) for x in patches_dict]
+                    s = time.time()
+                    patches = np.rec.fromarrays(patches_dict.values(), dtype=t)
+                    logger.info("Loading patches: %f" % (time.time() - s))
 
-                s = time.time()
-                patches = np.rec.fromarrays(patches_dict.values(), dtype=t)
-                logger.info("Loading patches: %f" % (time.time() - s))
+                    if use_cache:
+                        cls._save_cache(filename, patches)
         else:
-            # Broadcast metadata to the correct shape
-            for n, m in metadata.items():
-                metadata[n] = np.moveaxis(np.broadcast_to(m, (2, 2, m.size)), -1, 0)
+            # Only metadata (2 x 2 patches per frame)
+            locations_shape = (metadata["times"].shape[0], 2, 2)
+            patches = np.rec.fromarrays([np.arange(np.prod(locations_shape), dtype=np.uint32).reshape(locations_shape)],
+                                        dtype=[("index", np.uint32)])
 
-            # Create type
-            t = [(x, metadata[x].dtype) for x in metadata]
-            patches = np.rec.fromarrays(metadata.values(), dtype=t)
+        # The metadata is only stored once per frame and joined to the patches on access
+        t = [(x, metadata[x].dtype, metadata[x].shape[1:]) for x in metadata]
+        frame_metadata = np.rec.fromarrays(metadata.values(), dtype=t)
+
+        frame_size = int(np.prod(locations_shape[1:]))
+        logger.info("Frame metadata: %.1f MB (%.1f MB if stored per patch)" % (frame_metadata.nbytes / 1e6, frame_metadata.nbytes * frame_size / 1e6))
 
         obj = patches.view(cls)
 
@@ -219,16 +268,52 @@ class PatchArray(np.recarray):
         obj.receptive_field = receptive_field
         obj.image_size      = image_size
         obj.contains_features     = contains_features
+        obj.features_loaded       = contains_features and load_features
         obj.contains_locations    = contains_locations
         obj.contains_bins         = contains_bins
         obj.contains_patch_labels = contains_patch_labels
         obj.rasterizations        = rasterizations
         obj.contains_mahalanobis_distances = contains_mahalanobis_distances
+        obj.frame_metadata        = frame_metadata
+        obj.frame_size            = frame_size
 
         cls.root = obj
 
         return obj
 
+    #################
+    #     Cache     #
+    #################
+
+    @staticmethod
+    def _load_cache(filename):
+        """Memory-map the patches of a features file from the cache (see utils.load_cache)
+
+        Args:
+            filename (str): Features file (*.h5)
+
+        Returns:
+            Record array backed by the cache (copy on write) or None if there is no valid cache
+        """
+        s = time.time()
+        patches = utils.load_cache(filename, mode="c")
+        if patches is None:
+            return None
+        logger.info("Mapping patches from cache: %f" % (time.time() - s))
+        return patches.view(np.recarray)
+
+    @staticmethod
+    def _save_cache(filename, patches):
+        """Write the patches of a features file to the cache (see utils.save_cache)
+
+        Args:
+            filename (str): Features file (*.h5)
+            patches (np.recarray): Patches read from the file
+        """
+        if patches.size == 0:
+            return
+        utils.save_cache(filename, patches)
+
     def __array_finalize__(self, obj):
         if obj is None: return
         self._ilu = getattr(obj, "_ilu", None)
@@ -237,34 +322,68 @@ class PatchArray(np.recarray):
         self.receptive_field       = getattr(obj, "receptive_field", None)
         self.image_size            = getattr(obj, "image_size", 224)
         self.contains_features     = getattr(obj, "contains_features", False)
+        self.features_loaded       = getattr(obj, "features_loaded", False)
         self.contains_locations    = getattr(obj, "contains_locations", False)
         self.contains_bins         = getattr(obj, "contains_bins", {"0.20": False, "0.50": False, "2.00": False})
         self.contains_patch_labels = getattr(obj, "contains_patch_labels", False)
         self.rasterizations        = getattr(obj, "rasterizations", {"0.20": None, "0.50": None, "2.00": None})
         self.contains_mahalanobis_distances = getattr(obj, "contains_mahalanobis_distances", False)
+        self.frame_metadata        = getattr(obj, "frame_metadata", None)
+        self.frame_size            = getattr(obj, "frame_size", 1)
     
+    def _is_frame_metadata(self, attr):
+        frame_metadata = self.__dict__.get("frame_metadata", None)
+        return frame_metadata is not None and attr in frame_metadata.dtype.names and \
+               (self.dtype.names is None or attr not in self.dtype.names)
+
+    def _frame_indices(self):
+        """Index of the frame of every patch"""
+        return self["index"] // self.frame_size
+
+    def _join_frame_metadata(self, attr):
+        """Get the metadata of the frame of every patch"""
+        column = self.frame_metadata[attr]
+        if self.ndim == 3 and self.size > 0:
+            # All patches in a row belong to the same frame --> broadcast (read-only, without a copy)
+            column = column[self["index"][:, 0, 0] // self.frame_size]
+            return np.broadcast_to(column[:, np.newaxis, np.newaxis], self.shape + column.shape[1:], subok=True)
+        return column[self._frame_indices()]
+
+    def __getattr__(self, attr):
+        # Only called if there is no field or attribute with this name
+        if self._is_frame_metadata(attr):
+            return self._join_frame_metadata(attr)
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, attr))
+
     def __setattr__(self, attr, val):
-        if self.dtype.names is not None and attr in self.dtype.names:
-            # Try finding the attribute in the metadata (will throw if there it is not in metadata)
+        if self._is_frame_metadata(attr):
+            # Set the metadata of the frames where there was a change
+            frames = self._frame_indices()
+            old_val = self.frame_metadata[attr][frames]
+            val = np.broadcast_to(val, old_val.shape)
+            changed = old_val != val
+            if np.any(changed):
+                self.frame_metadata[attr][frames[changed]] = val[changed]
+                if attr != "changed":
+                    self.frame_metadata["changed"][frames[changed]] = True
+        elif self.dtype.names is not None and attr in self.dtype.names:
             old_val = self.__getattribute__(attr)
             if not np.all(old_val == val): # Check if any value changed
-                if attr != "changed" and attr in self.__metadata_attrs__:
-                    # Set changed to true, where there was a change
-                    if len(self.shape) > 0:
-                        self["changed"][old_val != val] = True
-                    else:
-                        self["changed"] = True
-
                 # Change the value
                 np.recarray.__setattr__(self, attr, val)
         else:
             object.__setattr__(self, attr, val)
 
     def __getitem__(self, indx):
+        if isinstance(indx, str) and self._is_frame_metadata(indx):
+            return self._join_frame_metadata(indx)
+
         obj = np.recarray.__getitem__(self, indx)
 
         if isinstance(obj, np.record):
             obj.__class__ = Patch
+            object.__setattr__(obj, "_frame_metadata", self.frame_metadata)
+            object.__setattr__(obj, "_frame_size", self.frame_size)
         
         return obj
     
@@ -273,7 +392,10 @@ class PatchArray(np.recarray):
     #################
 
     def _filter(self, name, f):
-        return self[f(self[name][:, 0, 0])] if self.ndim == 3 else self[f(self[name][:])]
+        return self[self._filter_mask(name, f)]
+
+    def _filter_mask(self, name, f):
+        return f(self[name][:, 0, 0]) if self.ndim == 3 else f(self[name][:])
 
     unknown_anomaly = property(lambda self: self._filter("labels", lambda f: f == 0))
     no_anomaly      = property(lambda self: self._filter("labels", lambda f: f == 1))
@@ -330,7 +452,12 @@ class PatchArray(np.recarray):
 
     @property
     def training(self):
-        return self.direction_ccw
+        return self[self.training_mask]
+
+    @property
+    def training_mask(self):
+        """ Boolean array selecting the training frames (or patches if not 3 dimensional) """
+        return self._filter_mask("directions", lambda f: f == 1)
 
     @property
     def validation(self):
@@ -356,8 +483,9 @@ class PatchArray(np.recarray):
             with h5py.File(filename, "r+") as hf:
                 hf.attrs["Last changed"] = datetime.now().strftime("%d.%m.%Y, %H:%M:%S")
 
-                indices = np.argwhere(np.isin(hf["times"], self.metadata_changed[:, 0, 0].times))
-                for index, frame in zip(indices, self.metadata_changed[:, 0, 0]):
+                changed = self.frame_metadata[self.frame_metadata.changed]
+                indices = np.argwhere(np.isin(hf["times"], changed.times))
+                for index, frame in zip(indices, changed):
                     for meta in self.__metadata_attrs__:
                         hf[meta][index] = frame[meta]
             return True
@@ -389,115 +517,175 @@ class PatchArray(np.recarray):
     #################
 
     def _calculate_grid(self, cell_size, fake=False):
-        key = "%.2f" % cell_size
-        if fake: key = "fake_" + key
+        """Get the grid for the given cell size
 
+        Returns:
+            Tuple (shape, origin) with the shape (V, U) of the grid and the
+            real world coordinates (y, x) of its corner
+        """
         # Get extent
         x_min, y_min, x_max, y_max = self.get_extent(cell_size, fake=fake)
 
         # Create the bins
         bins_y = np.arange(y_min, y_max, cell_size)
         bins_x = np.arange(x_min, x_max, cell_size)
-        bin_area = cell_size * cell_size
 
         shape = (len(bins_y), len(bins_x))
-
-        # Create the grid
-        self.rasterizations[key] = np.zeros(shape, dtype=object)
-        
-        for v, y in enumerate(bins_y):
-            for u, x in enumerate(bins_x):
-                b = box(y, x, y + cell_size, x + cell_size)
-                b.u = u
-                b.v = v
-                b.patches = list()
-                self.rasterizations[key][v, u] = b
-            
-        # Create a search tree of spatial boxes
-        grid = STRtree(self.rasterizations[key].ravel().tolist())
         
-        return (grid, shape)
+        return (shape, (y_min, x_min))
+
+    def _corners(self, fake=False):
+        """Real world coordinates (y, x) of the corners (tl, tr, br, bl) of every patch as an array (n, h, w, 4, 2)
+        (view on the locations, so it can also be written to)"""
+        key = "locations"
+        if fake: key = "fake_" + key
+        return np.ndarray.view(np.asarray(self[key]), np.dtype((np.float32, (4, 2))))
 
-    def _bin(self, i, grid, shape, rf_factor, key, fake):
-        for y, x in np.ndindex(self.shape[1:]):
-            if fake or rf_factor < 2 or (y, x) == (0, 0):
-                f = self[i, y, x]
-                poly = Polygon([f.locations.tl, f.locations.tr, f.locations.br, f.locations.bl])
-                poly = poly.buffer(0.99)
-                bins = grid.query(poly)
+    def _bin(self, start, stop, shape, origin, cell_size, rf_factor, fake):
+        """Get the bins of every patch in the frames start to stop
 
-                # pr = prep(poly)
-                # bins = filter(pr.intersects, bins)
-                
-            def _loop():
-                for b in bins:
-                    # weight = 1.0#b.intersection(poly).area / bin_area
-                    b.patches.append(np.ravel_multi_index((i, y, x), self.shape))
-                    yield np.ravel_multi_index((b.v, b.u), shape)
-                
-            self[i, y, x]["bins_" + key] = np.array(list(_loop()), dtype=np.uint32)
+        Returns:
+            Tuple (counts, indices) with the number of bins per patch and the flat bin indices
+        """
+        # Patches with large receptive fields use the bins of the first patch in the frame
+        bounds = Rasterization.footprint_bounds(self._corners()[start:stop], large_rf=not fake and rf_factor >= 2)
+        return Rasterization.cover(bounds, shape, origin, cell_size)
 
-    def _save_rasterization(self, key, grid, shape, start=None, end=None):
+    def _save_rasterization(self, key, rasterization, start=None, end=None):
         logger.info("Opening %s" % self.filename)
         # Save to file
         with h5py.File(self.filename, "r+") as hf:
-            # Remove the old dataset
-            if "bins_" + key in hf.keys():
-                logger.info("Deleting old bins_%s from file" % key)
-                del hf["bins_" + key]
+            rasterization.save(hf, key, start, end)
+
+    def calculate_rasterization(self, cell_size, fake=False, n_jobs=1):
+        """Calculate the bins of every patch and save them to the file
+
+        Args:
+            cell_size (float): Width and height of a bin in meter
+            fake (bool): Use the fake locations for the extent
+            n_jobs (int): Number of processes used for rasterization (-1: all cores)
+
+        Returns:
+            Shape of the grid
+        """
+        return self.calculate_rasterizations([cell_size], fake=fake, n_jobs=n_jobs)[0]
+
+    def calculate_rasterizations(self, cell_sizes, fake=False, n_jobs=1):
+        """Calculate the bins of every patch for multiple cell sizes in a single pass and save them to the file.
+        Cell sizes that are multiples of the smallest one (eg. 0.2 and 2.0) are derived from its bins.
+
+        Args:
+            cell_sizes (list): Widths and heights of the bins in meter
+            fake (bool): Use the fake locations for the extent
+            n_jobs (int): Number of processes used for rasterization (-1: all cores)
+
+        Returns:
+            List with the shapes of the grids
+        """
+        keys = [("fake_%.2f" if fake else "%.2f") % cell_size for cell_size in cell_sizes]
+        missing = list()
+
+        for key, cell_size in zip(keys, cell_sizes):
+            # Check if cell size is already calculated
+            if key in self.contains_bins.keys() and self.contains_bins[key]:
+                continue
             
-            logger.info("Writing bins_%s to file" % key)
-            hf.create_dataset("bins_" + key, data=self["bins_" + key], dtype=h5py.vlen_dtype(np.uint32))
+            # Only rasterize new frames if there is a rasterization of the first frames
+            rasterization = self.rasterizations.get(key, None)
+            if rasterization is not None and rasterization.origin is not None and \
+               0 < rasterization.num_patches < self.size and rasterization.num_patches % np.prod(self.shape[1:]) == 0:
+                self.update_rasterization(cell_size, fake=fake, n_jobs=n_jobs)
+                continue
             
-            # Remove the old dataset
-            if "rasterization_" + key in hf.keys():
-                logger.info("Deleting old rasterization_%s from file" % key)
-                del hf["rasterization_" + key]
-
-            if "rasterization_" + key + "_count" in hf.keys():
-                logger.info("Deleting old rasterization_%s_count from file" % key)
-                del hf["rasterization_" + key + "_count"]
+            missing.append((key, cell_size))
+
+        if len(missing) > 0:
+            grids = list()
+            for key, cell_size in missing:
+                shape, origin = self._calculate_grid(cell_size, fake=fake)
+                logger.info("%i bins in x and %i bins in y direction (with cell size %.2f)" % (shape + (cell_size,)))
+                grids.append((shape, origin, cell_size))
+
+            rf_factor = self.receptive_field[0] / self.image_size
+
+            start = time.time()
             
-            logger.info("Writing rasterization_%s and rasterization_%s_count to file" % (key, key))
-            rasterization       = hf.create_dataset("rasterization_" + key,            shape=shape, dtype=h5py.vlen_dtype(np.uint32))
-            rasterization_count = hf.create_dataset("rasterization_" + key + "_count", shape=shape, dtype=np.uint16)
+            # Get the corresponding bins for every feature
+            rasterizations = Rasterization.calculate_multiple(self._corners(), grids,
+                                                              large_rf=not fake and rf_factor >= 2, n_jobs=n_jobs)
 
-            for b in grid._geoms:
-                rasterization[b.v, b.u] = b.patches
-                rasterization_count[b.v, b.u] = len(b.patches)
+            end = time.time()
 
-            if start is not None and end is not None:
-                hf["rasterization_" + key].attrs["Start"] = start
-                hf["rasterization_" + key].attrs["End"] = end
-                hf["rasterization_" + key].attrs["Duration"] = end - start
-                hf["rasterization_" + key].attrs["Duration (formatted)"] = utils.format_duration(end - start)
+            logger.info("Opening %s" % self.filename)
+            with h5py.File(self.filename, "r+") as hf:
+                for (key, _), rasterization in zip(missing, rasterizations):
+                    rasterization.save(hf, key, start, end)
+                    self.contains_bins[key] = True
+                    self.rasterizations[key] = rasterization
+
+        return [self.rasterizations[key].shape for key in keys]
+
+    def update_rasterization(self, cell_size, fake=False, n_jobs=1):
+        """Rasterize the frames that were appended since the last rasterization.
+        The grid grows by whole cells if the new frames are outside of it. Only if it grows the
+        whole rasterization is written to the file again, else only the bins of the new frames.
+
+        Args:
+            cell_size (float): Width and height of a bin in meter
+            fake (bool): Use the fake locations for the extent
+            n_jobs (int): Number of processes used for rasterization (-1: all cores)
 
-    def calculate_rasterization(self, cell_size, fake=False):
+        Returns:
+            Shape of the grid
+        """
         key = "%.2f" % cell_size
         if fake: key = "fake_" + key
 
-        # Check if cell size is already calculated
-        if key in self.contains_bins.keys() and self.contains_bins[key]:
-            return self["bins_" + key]
-        
-        grid, shape = self._calculate_grid(cell_size, fake=fake)
-
-        rf_factor = self.receptive_field[0] / self.image_size
+        rasterization = self.rasterizations[key]
+        frame_size = int(np.prod(self.shape[1:]))
+        first = rasterization.num_patches // frame_size # First new frame
+        large_rf = not fake and self.receptive_field[0] / self.image_size >= 2
 
-        logger.info("%i bins in x and %i bins in y direction (with cell size %.2f)" % (shape + (cell_size,)))
+        logger.info("Rasterizing %i new frames (with cell size %.2f)" % (self.shape[0] - first, cell_size))
 
         start = time.time()
+
+        # Grow the grid to fit the new frames (the extent is cheap, only binning is expensive)
+        shape, origin = self._calculate_grid(cell_size, fake=fake)
+        old_shape, old_origin = rasterization.shape, rasterization.origin
         
-        # Get the corresponding bin for every feature
-        Parallel(n_jobs=2, prefer="threads")(
-            delayed(self._bin)(i, grid, shape, rf_factor, key, fake) for i in tqdm(range(self.shape[0]), desc="Calculating bins", file=sys.stderr))
+        origin = (min(origin[0], old_origin[0]), min(origin[1], old_origin[1]))
+        dv = int(round((old_origin[0] - origin[0]) / cell_size))
+        du = int(round((old_origin[1] - origin[1]) / cell_size))
+        shape = (max(shape[0], dv + old_shape[0]), max(shape[1], du + old_shape[1]))
+
+        grown = shape != old_shape
+        corners = self._corners()
+
+        if grown:
+            logger.info("Growing grid from %i x %i to %i x %i bins" % (old_shape + shape))
+            rasterization.grow(shape, origin)
+            
+            # Old patches that reach out of the old grid might now have more bins
+            bounds = Rasterization.footprint_bounds(corners[:first], large_rf)
+            outside = np.flatnonzero((bounds[:, 0] < old_origin[0]) | (bounds[:, 1] < old_origin[1]) |
+                                     (bounds[:, 2] > old_origin[0] + old_shape[0] * cell_size) |
+                                     (bounds[:, 3] > old_origin[1] + old_shape[1] * cell_size))
+            if outside.size > 0:
+                counts, indices = Rasterization.cover(bounds[outside], shape, origin, cell_size)
+                rasterization.set_bins(outside, counts, indices)
+
+        rasterization.extend(Rasterization.calculate(corners[first:], shape, origin, cell_size, large_rf=large_rf, n_jobs=n_jobs))
 
         end = time.time()
 
-        self._save_rasterization(key, grid, shape, start, end)
-        
+        with h5py.File(self.filename, "r+") as hf:
+            if grown:
+                rasterization.save(hf, key, start, end)
+            else:
+                rasterization.append(hf, key, first * frame_size, start, end)
+
         self.contains_bins[key] = True
-        self.rasterizations[key] = np.vectorize(lambda b: b.patches, otypes=[object])(self.rasterizations[key])
 
         return shape
 
@@ -534,7 +722,7 @@ class PatchArray(np.recarray):
         """Calculate the receptive field of a patch
 
         Args:
-            y, x (int): Patch indices
+            y, x (int, array): Patch indices
             scale_y, scale_x (float): Scale factor
 
         Returns:
@@ -544,8 +732,8 @@ class PatchArray(np.recarray):
         image_w = self.image_size * scale_x
 
         _, h, w = self.locations.shape
-        center_y = y / float(h) * image_h
-        center_x = x / float(w) * image_w
+        center_y = np.divide(y, float(h)) * image_h
+        center_x = np.divide(x, float(w)) * image_w
 
         if fake:
             rf_h = self.image_size / float(self.shape[1]) * scale_y / 2.0
@@ -554,40 +742,79 @@ class PatchArray(np.recarray):
             rf_h = self.receptive_field[0] * scale_y / 2.0
             rf_w = self.receptive_field[1] * scale_x / 2.0
 
+        top    = np.maximum(0, center_y - rf_h)
+        bottom = np.minimum(image_h, center_y + rf_h)
+        left   = np.maximum(0, center_x - rf_w)
+        right  = np.minimum(image_w, center_x + rf_w)
         
-        tl = (max(0, center_y - rf_h), max(0, center_x - rf_w))
-        tr = (max(0, center_y - rf_h), min(image_w, center_x + rf_w))
-        br = (min(image_h, center_y + rf_h), min(image_w, center_x + rf_w))
-        bl = (min(image_h, center_y + rf_h), max(0, center_x - rf_w))
+        tl = (top, left)
+        tr = (top, right)
+        br = (bottom, right)
+        bl = (bottom, left)
         
         return (tl, tr, br, bl)
 
+    @staticmethod
+    def _receptive_fields_key(receptive_field, image_size, grid_shape, fake):
+        if receptive_field is not None:
+            receptive_field = tuple(np.asarray(receptive_field).tolist())
+        if image_size is not None:
+            image_size = int(image_size)
+        return (receptive_field, image_size, tuple(grid_shape), bool(fake))
+
+    @staticmethod
+    def _receptive_fields_dataset(fake):
+        return "receptive_fields_fake" if fake else "receptive_fields"
+
+    def get_receptive_fields(self, fake=False):
+        """Get the receptive fields of all patches of a frame (in image coordinates)
+        The table is only calculated once per extractor, image size and grid shape
+        and is stored in the features file with the locations.
+
+        Args:
+            fake (bool): Use the fake receptive fields (the image divided into equal patches)
+
+        Returns:
+            Array of shape (h, w, 4, 2) with the pixel coordinates (y, x) of
+            the corners (tl, tr, br, bl) of every receptive field
+        """
+        key = self._receptive_fields_key(self.receptive_field, self.image_size, self.shape[1:], fake)
+        table = self.__receptive_fields__.get(key, None)
+        if table is None:
+            table = self._get_receptive_fields(fake)
+            table.flags.writeable = False
+            self.__receptive_fields__[key] = table
+        return table
+
     #################
     #   Locations   #
     #################
     
     def _get_receptive_fields(self, fake=False):
-        """ Get the receptive fields for each patch (in image coordinates) """
+        """ Calculate the receptive fields for each patch (in image coordinates) """
         n, h, w = self.locations.shape
         
-        image_locations = np.zeros((h, w, 4, 2), dtype=np.float32)
-        
-        for (y, x) in np.ndindex((h, w)):
-            rf = self.calculate_receptive_field(y + 0.5, x + 0.5, fake=fake)
-            image_locations[y, x, 0] = rf[0]
-            image_locations[y, x, 1] = rf[1]
-            image_locations[y, x, 2] = rf[2]
-            image_locations[y, x, 3] = rf[3]
-        
-        return image_locations
+        y, x = np.meshgrid(np.arange(h) + 0.5, np.arange(w) + 0.5, indexing="ij")
+        rf = self.calculate_receptive_field(y, x, fake=fake)
+
+        return np.stack([np.stack(corner, axis=-1) for corner in rf], axis=-2).astype(np.float32) # (h, w, 4, 2)
 
     def _image_to_relative(self, image_locations):
         return self._ilu.image_to_relative(image_locations, image_width=self.image_size, image_height=self.image_size)         # (h, w, 4, 2)
     
     def _relative_to_absolute(self, relative_locations, camera_locations):
-        res = self._ilu.relative_to_absolute(relative_locations, camera_locations)
-        res = np.rec.fromarrays(res.transpose(), dtype=[("y", np.float32), ("x", np.float32)]).transpose()
-        return np.rec.fromarrays(res.transpose(), dtype=self.locations.dtype) # No transpose here smh
+        """Transform the relative corners of the receptive fields with the camera location of every frame
+
+        Args:
+            relative_locations (array): Corners relative to the camera (h, w, 4, 2)
+            camera_locations (array): Structured array with the camera location of every frame (n,)
+
+        Returns:
+            Array (n, w, h, 4, 2) with the absolute corners
+        """
+        # The grid axes are swapped (w, h) like the record conversion used to do,
+        # the map overlay in Visualize relies on this order
+        return self._ilu.relative_to_absolute(relative_locations, camera_locations).swapaxes(1, 2)
 
     def _save_patch_locations(self, fake=False, start=None, end=None):
         key = "locations"
@@ -600,6 +827,13 @@ class PatchArray(np.recarray):
             
             hf.create_dataset(key, data=self[key])
             
+            # Store the receptive fields so they are not recalculated (eg. in Visualize)
+            # (as a dataset, the table of large grids exceeds the 64 KiB limit of attributes)
+            rf_key = self._receptive_fields_dataset(fake)
+            if rf_key in hf.keys():
+                del hf[rf_key]
+            hf.create_dataset(rf_key, data=self.get_receptive_fields(fake))
+
             if start is not None and end is not None:
                 hf[key].attrs["Start"] = start
                 hf[key].attrs["End"] = end
@@ -616,12 +850,12 @@ class PatchArray(np.recarray):
         logger.info("Calculating locations of every patch")
         
         start = time.time()
-        image_locations = self._get_receptive_fields(fake)
+        image_locations = self.get_receptive_fields(fake)
         
         relative_locations = self._image_to_relative(image_locations)
         
-        for i in tqdm(range(self[key].shape[0]), desc="Calculating locations", file=sys.stderr):
-            self[key][i] = self._relative_to_absolute(relative_locations, self[i, 0, 0].camera_locations)
+        # All frames at once, written directly to the locations
+        self._corners(fake)[...] = self._relative_to_absolute(relative_locations, self.camera_locations[:, 0, 0])
 
         end = time.time()
 
@@ -633,59 +867,168 @@ class PatchArray(np.recarray):
     # Calculations  #
     #################
     
+    def moments(self, chunk_size=8192):
+        """Calculate mean and variance of the features in a single pass
+        
+        Args:
+            chunk_size (int): Approximate number of patches processed at once
+
+        Returns:
+            MomentAccumulator
+        """
+        moments = MomentAccumulator()
+
+        if self.ndim == 0:
+            return moments.update(self.features)
+
+        rows = max(1, chunk_size // max(1, int(np.prod(self.shape[1:]))))
+        for s in range(0, self.shape[0], rows):
+            moments.update(self[s:s + rows].features)
+        return moments
+
     def var(self):
-        return np.var(self.ravel().features, axis=0, dtype=np.float64)
+        return self.moments().var
 
     def cov(self):
         return np.cov(self.ravel().features, rowvar=False)
 
     def mean(self):
-        return np.mean(self.ravel().features, axis=0, dtype=np.float64)
+        return self.moments().mean
 
     #################
     #      Misc     #
     #################
     
-    def to_dataset(self):
+    def to_dataset(self, images_path=None):
+        """Dataset of the decoded frames of this array (see utils.load_jpgs)
+        Reading and decoding the images runs in parallel inside tf.data.
+
+        Args:
+            images_path (str): Directory with the images (Default: consts.IMAGES_PATH)
+
+        Returns:
+            tf.data.Dataset of (image (RGB), time)
+        """
+        return self._load_images(self[:, 0, 0].times, images_path)
+
+    @staticmethod
+    def _load_images(times, images_path=None):
         import tensorflow as tf
 
-        def _gen():
-            for i in range(self.shape[0]):
-                rgb = cv2.cvtColor(self[i, 0, 0].get_image(), cv2.COLOR_BGR2RGB)
-                yield (np.array(rgb), self[i, 0, 0].times)
+        if images_path is None: images_path = consts.IMAGES_PATH
 
-        raw_dataset = tf.data.Dataset.from_generator(
-            _gen,
-            output_types=(tf.uint8, tf.int64),
-            output_shapes=((None, None, None), ()))
+        times = np.array(times, dtype=np.int64)
+        files = [os.path.join(images_path, "%i.jpg" % t) for t in times]
 
-        return raw_dataset.prefetch(tf.data.experimental.AUTOTUNE)
+        raw_dataset = tf.data.Dataset.from_tensor_slices((files, times))
+
+        def _decode_function(file_path, time):
+            # Load and decode image (with the same accurate DCT as cv2.imread)
+            image = tf.io.read_file(file_path)
+            image = tf.image.decode_jpeg(image, channels=3, dct_method="INTEGER_ACCURATE")
+            return image, time
+
+        return raw_dataset.map(_decode_function, num_parallel_calls=tf.data.experimental.AUTOTUNE) \
+                          .prefetch(tf.data.experimental.AUTOTUNE)
 
     isview = property(lambda self: np.shares_memory(self, self.root))
 
+    def _temporal_windows(self, times, temporal_batch_size):
+        """Get the frames of the temporal windows. The window of a frame contains the
+        temporal_batch_size frames of the same round before it, padded with the first frame of the round.
+
+        Args:
+            times (array): Times of the frames
+            temporal_batch_size (int): Number of frames per window
+
+        Returns:
+            np.ndarray of shape (frames, temporal_batch_size) with indices into self.root
+        """
+        root = self.root[:, 0, 0]
+        root_times  = np.asarray(root.times)
+        root_rounds = np.asarray(root.round_numbers)
+
+        # Index of every frame in the root array
+        order   = np.argsort(root_times, kind="stable")
+        indices = order[np.searchsorted(root_times, np.asarray(times), sorter=order)]
+
+        # Root indices grouped by round (in the original order) and the position of every frame in its round
+        by_round = np.argsort(root_rounds, kind="stable")
+        first    = np.searchsorted(root_rounds[by_round], root_rounds[indices])
+        position = np.empty_like(by_round)
+        position[by_round] = np.arange(by_round.size)
+        position = position[indices] - first
+
+        offsets = np.arange(-temporal_batch_size, 0)
+        return by_round[first[:, None] + np.maximum(position[:, None] + offsets, 0)]
+
     def get_batch(self, frame, temporal_batch_size):
-        current_round = self.root.round_number(frame.round_numbers)
-        time_index = np.argwhere(current_round.times == frame.times).flat[0]
-        res = None
-        for res_i, arr_i in enumerate(range(time_index - temporal_batch_size, time_index)):
-            image = cv2.cvtColor(current_round[max(0, arr_i), 0, 0].get_image(), cv2.COLOR_BGR2RGB)
-            if res is None:
-                res = np.zeros((temporal_batch_size,) + image.shape)
-            res[res_i,...] = image
-        return res
-
-    def to_temporal_dataset(self, temporal_batch_size=16):
+        window = self._temporal_windows([frame.times], temporal_batch_size)[0]
+        root = self.root[:, 0, 0]
+        return np.stack([cv2.cvtColor(root[i].get_image(), cv2.COLOR_BGR2RGB) for i in window]).astype(np.float64)
+
+    def to_temporal_dataset(self, temporal_batch_size=16, images_path=None):
+        """Dataset of the temporal windows of the frames of this array (see get_batch)
+        Every frame is only decoded once (in parallel, see to_dataset) and kept in a ring buffer
+        of the last temporal_batch_size frames. The windows are views into the buffer.
+
+        Args:
+            temporal_batch_size (int): Number of frames per window
+            images_path (str): Directory with the images (Default: consts.IMAGES_PATH)
+
+        Returns:
+            tf.data.Dataset of (window (temporal_batch_size RGB images), time)
+        """
         import tensorflow as tf
 
+        times = np.array(self[:, 0, 0].times, dtype=np.int64)
+        windows = self._temporal_windows(times, temporal_batch_size)
+
+        # Frames pushed to the ring buffer. If a window overlaps the previous one only
+        # the new frames are pushed, otherwise the whole window is.
+        pushes = list()
+        emits  = list() # Index of the push that completes the window of every frame
+        previous = None
+        for window in windows:
+            shift = temporal_batch_size
+            if previous is not None:
+                for s in range(temporal_batch_size):
+                    if np.array_equal(window[:temporal_batch_size - s], previous[s:]):
+                        shift = s
+                        break
+            pushes.extend(window[temporal_batch_size - shift:])
+            emits.append(len(pushes) - 1)
+            previous = window
+
+        # Consecutive pushes of the same frame are only decoded once
+        pushes = np.array(pushes, dtype=np.int64)
+        decode = np.ones(pushes.shape, dtype=bool)
+        decode[1:] = pushes[1:] != pushes[:-1]
+        images = self._load_images(np.asarray(self.root[:, 0, 0].times)[pushes[decode]], images_path)
+
         def _gen():
-            for i in range(self.shape[0]):
-                temporal_batch = self.get_batch(self[i, 0, 0], temporal_batch_size)
-                yield (temporal_batch, self[i, 0, 0].times)
+            buffer = None   # Every frame is stored twice, so the last frames are always contiguous
+            frames = iter(images)
+            e = 0
+            for p in range(pushes.size):
+                if decode[p]:
+                    image = next(frames)[0].numpy()
+                if buffer is None:
+                    buffer = np.empty((2 * temporal_batch_size,) + image.shape, dtype=image.dtype)
+                
+                s = p % temporal_batch_size
+                buffer[s] = image
+                buffer[s + temporal_batch_size] = image
+                
+                s = (p + 1) % temporal_batch_size
+                while e < len(emits) and emits[e] == p:
+                    yield (buffer[s:s + temporal_batch_size], times[e])
+                    e += 1
 
         raw_dataset = tf.data.Dataset.from_generator(
             _gen,
             output_types=(tf.uint8, tf.int64),
-            output_shapes=((None, None, None, None), ()))
+            output_shapes=((temporal_batch_size, None, None, 3), ()))
 
         return raw_dataset.prefetch(tf.data.experimental.AUTOTUNE)
     
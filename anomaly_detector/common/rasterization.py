@@ -0,0 +1,483 @@
+import os
+import sys
+import shutil
+import tempfile
+
+import numpy as np
+import h5py
+from scipy import sparse
+from tqdm import tqdm
+from joblib import Parallel, delayed
+
+from common import utils, logger
+
+BUFFER = 0.99     # Patch footprints are buffered by 0.99 m
+BLOCK_SIZE = 8192 # Number of patches rasterized at once
+
+def _count_frames(corners, start, stop, grids, large_rf, counts):
+    """Worker: Write the number of bins of every patch in the frames start to stop to counts (one per grid)"""
+    frame_size = corners.shape[1] * corners.shape[2]
+    bounds = Rasterization.footprint_bounds(corners[start:stop], large_rf)
+    for c, (_, _, rows, cols) in zip(counts, Rasterization._grid_ranges(bounds, grids)):
+        c[start * frame_size:stop * frame_size] = rows * cols
+
+def _bin_frames(corners, start, stop, grids, large_rf, indptrs, indices):
+    """Worker: Write the bins of every patch in the frames start to stop to indices (one per grid)"""
+    frame_size = corners.shape[1] * corners.shape[2]
+    bounds = Rasterization.footprint_bounds(corners[start:stop], large_rf)
+    for grid, ranges, indptr, i in zip(grids, Rasterization._grid_ranges(bounds, grids), indptrs, indices):
+        Rasterization._enumerate(ranges, grid[0], out=i[indptr[start * frame_size]:indptr[stop * frame_size]])
+
+class Rasterization(object):
+    """Assignment of patches to the cells (bins) of a regular grid.
+    Both directions (patch --> bins and bin --> patches) are stored in CSR format:
+    The bins of patch i are patch_indices[patch_indptr[i]:patch_indptr[i + 1]] and
+    the patches of bin b are bin_indices[bin_indptr[b]:bin_indptr[b + 1]] (flat indices).
+    """
+    def __init__(self, shape, patch_indptr, patch_indices, bin_indptr=None, bin_indices=None, cell_size=None, origin=None):
+        """Create a new rasterization
+
+        Args:
+            shape (tuple): Shape of the grid (V, U)
+            patch_indptr (array): Offsets of the bins of each patch (N + 1,)
+            patch_indices (array): Flat bin indices
+            bin_indptr (array): Offsets of the patches of each bin (V * U + 1,) (Default: calculated)
+            bin_indices (array): Flat patch indices (Default: calculated)
+            cell_size (float): Width and height of a cell in meter
+            origin (tuple): Real world coordinates (y, x) of the grid corner
+        """
+        self.shape = tuple(int(s) for s in shape)
+        self.cell_size = cell_size
+        self.origin = origin
+
+        self.patch_indptr  = np.asarray(patch_indptr, dtype=np.int64)
+        self.patch_indices = np.asarray(patch_indices, dtype=np.uint32)
+
+        if bin_indptr is None or bin_indices is None:
+            bin_indptr, bin_indices = self._transpose(self.patch_indptr, self.patch_indices, self.size)
+
+        self.bin_indptr  = np.asarray(bin_indptr, dtype=np.int64)
+        self.bin_indices = np.asarray(bin_indices, dtype=np.uint32)
+
+    size        = property(lambda self: int(np.prod(self.shape)))
+    num_patches = property(lambda self: self.patch_indptr.size - 1)
+    bin_counts  = property(lambda self: np.diff(self.bin_indptr))
+
+    @staticmethod
+    def _transpose(indptr, indices, size):
+        """Get the other direction of a CSR index (scipy does this with a counting sort).
+        The indices of each row are in ascending order afterwards."""
+        data = np.ones(indices.size, dtype=np.int8)
+        t = sparse.csr_matrix((data, indices, indptr), shape=(indptr.size - 1, size)).tocsc()
+        return t.indptr, t.indices
+
+    @classmethod
+    def calculate(cls, corners, shape, origin, cell_size, large_rf=False, n_jobs=1):
+        """Rasterize patch footprints (see calculate_multiple)
+
+        Args:
+            corners (array): Real world coordinates (y, x) of the corners of every patch (n, h, w, 4, 2)
+            shape (tuple): Shape of the grid (V, U)
+            origin (tuple): Real world coordinates (y, x) of the grid corner
+            cell_size (float): Width and height of a cell
+            large_rf (bool): Patches with large receptive fields use the footprint of the first patch in each frame
+            n_jobs (int): Number of processes (joblib semantics, -1: all cores)
+
+        Returns:
+            A new Rasterization
+        """
+        return cls.calculate_multiple(corners, [(shape, origin, cell_size)], large_rf=large_rf, n_jobs=n_jobs)[0]
+
+    @classmethod
+    def calculate_multiple(cls, corners, grids, large_rf=False, n_jobs=1):
+        """Rasterize patch footprints into multiple grids in a single pass.
+        The footprints are only calculated once and grids with cells that are made of whole cells
+        of the finest grid (eg. 0.2 m and 2.0 m) are derived from the finest grid.
+
+        With n_jobs != 1 the frames are split into blocks that are rasterized by a pool of processes
+        in two passes (first the number of bins per patch, then the bins). The corners and both results
+        are shared with the workers as memory-mapped files, so nothing but frame ranges is sent to them.
+
+        Args:
+            corners (array): Real world coordinates (y, x) of the corners of every patch (n, h, w, 4, 2)
+            grids (list): Tuples (shape, origin, cell_size) of the grids
+            large_rf (bool): Patches with large receptive fields use the footprint of the first patch in each frame
+            n_jobs (int): Number of processes (joblib semantics, -1: all cores)
+
+        Returns:
+            List with a new Rasterization for every grid
+        """
+        n, h, w = corners.shape[:3]
+        frames_per_block = max(1, BLOCK_SIZE // (h * w))
+        blocks = [(s, min(s + frames_per_block, n)) for s in range(0, n, frames_per_block)]
+
+        indptrs = [np.zeros(n * h * w + 1, dtype=np.int64) for _ in grids]
+
+        if n_jobs == 1:
+            indices = [list() for _ in grids]
+            for start, stop in tqdm(blocks, desc="Calculating bins", file=sys.stderr):
+                bounds = cls.footprint_bounds(corners[start:stop], large_rf)
+                for grid, ranges, indptr, i in zip(grids, cls._grid_ranges(bounds, grids), indptrs, indices):
+                    block_indptr = indptr[start * h * w + 1:stop * h * w + 1]
+                    np.cumsum(ranges[2] * ranges[3], out=block_indptr)
+                    block_indptr += indptr[start * h * w]
+                    i.append(cls._enumerate(ranges, grid[0]))
+            indices = [np.concatenate(i) if len(i) > 0 else np.zeros(0, dtype=np.uint32) for i in indices]
+        else:
+            folder = tempfile.mkdtemp(prefix="rasterization_")
+            try:
+                shared_corners = np.memmap(os.path.join(folder, "corners"), dtype=np.float32, mode="w+", shape=corners.shape)
+                for start, stop in blocks:
+                    shared_corners[start:stop] = corners[start:stop]
+                
+                counts = [np.memmap(os.path.join(folder, "counts_%i" % g), dtype=np.int64, mode="w+", shape=(n * h * w,))
+                          for g in range(len(grids))]
+
+                with Parallel(n_jobs=n_jobs) as parallel:
+                    parallel(delayed(_count_frames)(shared_corners, start, stop, grids, large_rf, counts)
+                             for start, stop in tqdm(blocks, desc="Counting bins", file=sys.stderr))
+
+                    shared_indices = list()
+                    for g, (indptr, c) in enumerate(zip(indptrs, counts)):
+                        np.cumsum(c, out=indptr[1:])
+                        shared_indices.append(np.memmap(os.path.join(folder, "indices_%i" % g), dtype=np.uint32, mode="w+",
+                                                        shape=(max(1, indptr[-1]),)))
+                    
+                    parallel(delayed(_bin_frames)(shared_corners, start, stop, grids, large_rf, indptrs, shared_indices)
+                             for start, stop in tqdm(blocks, desc="Calculating bins", file=sys.stderr))
+
+                indices = [np.array(i[:indptr[-1]]) for i, indptr in zip(shared_indices, indptrs)]
+            finally:
+                shutil.rmtree(folder, ignore_errors=True)
+
+        return [cls(shape, indptr, i, cell_size=cell_size, origin=origin)
+                for (shape, origin, cell_size), indptr, i in zip(grids, indptrs, indices)]
+
+    @staticmethod
+    def footprint_bounds(corners, large_rf=False):
+        """Get the buffered bounding boxes of patch footprints
+
+        Args:
+            corners (array): Real world coordinates (y, x) of the corners of every patch (n, h, w, 4, 2)
+            large_rf (bool): Patches with large receptive fields use the footprint of the first patch in each frame
+
+        Returns:
+            Bounding boxes (y_min, x_min, y_max, x_max) of shape (n * h * w, 4)
+        """
+        corners = np.asarray(corners, dtype=np.float64)
+        if large_rf:
+            corners = np.broadcast_to(corners[:, :1, :1], corners.shape)
+
+        return np.concatenate([corners.min(axis=-2) - BUFFER,
+                               corners.max(axis=-2) + BUFFER], axis=-1).reshape(-1, 4)
+
+    @staticmethod
+    def _cell_ranges(bounds, shape, origin, cell_size):
+        """Get the cell ranges (v_lo, u_lo, rows, cols) that intersect the bounding boxes"""
+        V, U = shape
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        y = (bounds[:, [0, 2]] - origin[0]) / cell_size
+        x = (bounds[:, [1, 3]] - origin[1]) / cell_size
+
+        # Cell v covers [v, v + 1] in grid coordinates
+        v_lo = np.clip(np.ceil(y[:, 0] - 1),  0, V).astype(np.int64)
+        v_hi = np.clip(np.floor(y[:, 1]), -1, V - 1).astype(np.int64)
+        u_lo = np.clip(np.ceil(x[:, 0] - 1),  0, U).astype(np.int64)
+        u_hi = np.clip(np.floor(x[:, 1]), -1, U - 1).astype(np.int64)
+
+        rows = np.maximum(v_hi - v_lo + 1, 0)
+        cols = np.maximum(u_hi - u_lo + 1, 0)
+        return v_lo, u_lo, rows, cols
+
+    @staticmethod
+    def _nesting(fine, coarse):
+        """Get (factor, offset_v, offset_u) if every cell of the coarse grid is made of whole cells of the fine grid"""
+        _, fine_origin, fine_size = fine
+        _, coarse_origin, coarse_size = coarse
+
+        factor = coarse_size / float(fine_size)
+        offset_v = (fine_origin[0] - coarse_origin[0]) / fine_size
+        offset_u = (fine_origin[1] - coarse_origin[1]) / fine_size
+        
+        if any(abs(f - round(f)) > 1e-3 for f in (factor, offset_v, offset_u)):
+            return None
+        return int(round(factor)), int(round(offset_v)), int(round(offset_u))
+
+    @staticmethod
+    def _grid_ranges(bounds, grids):
+        """Get the cell ranges (v_lo, u_lo, rows, cols) that intersect the bounding boxes in every grid.
+        Ranges in grids that nest in the finest grid are derived from it by integer division."""
+        finest = int(np.argmin([cell_size for _, _, cell_size in grids]))
+        fine_ranges = Rasterization._cell_ranges(bounds, *grids[finest])
+        
+        result = list()
+        for grid in grids:
+            nesting = Rasterization._nesting(grids[finest], grid)
+            if grid is grids[finest]:
+                result.append(fine_ranges)
+            elif nesting is None:
+                result.append(Rasterization._cell_ranges(bounds, *grid))
+            else:
+                factor, offset_v, offset_u = nesting
+                (V, U), _, _ = grid
+                v_lo, u_lo, rows, cols = fine_ranges
+                empty = (rows == 0) | (cols == 0)
+
+                v_hi = np.clip((v_lo + rows - 1 + offset_v) // factor, 0, V - 1)
+                u_hi = np.clip((u_lo + cols - 1 + offset_u) // factor, 0, U - 1)
+                v_lo = np.clip((v_lo + offset_v) // factor, 0, V - 1)
+                u_lo = np.clip((u_lo + offset_u) // factor, 0, U - 1)
+
+                result.append((v_lo, u_lo, np.where(empty, 0, v_hi - v_lo + 1), np.where(empty, 0, u_hi - u_lo + 1)))
+        return result
+
+    @staticmethod
+    def _enumerate(ranges, shape, out=None):
+        """Get the flat indices of all cells in the ranges (v_lo, u_lo, rows, cols) row by row"""
+        v_lo, u_lo, rows, cols = ranges
+        counts = rows * cols
+
+        box = np.repeat(np.arange(counts.size), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        v = v_lo[box] + k // cols[box]
+        u = u_lo[box] + k %  cols[box]
+
+        if out is None:
+            out = np.empty(k.size, dtype=np.uint32)
+        np.multiply(v, shape[1], out=v)
+        np.add(v, u, out=out, casting="unsafe")
+        return out
+
+    @staticmethod
+    def cover(bounds, shape, origin, cell_size, out=None):
+        """Get the cells of a regular grid that intersect axis aligned bounding boxes.
+        Cells are closed, so boxes that only touch a cell still intersect it.
+
+        Args:
+            bounds (array): Bounding boxes (y_min, x_min, y_max, x_max) of shape (N, 4)
+            shape (tuple): Shape of the grid (V, U)
+            origin (tuple): Real world coordinates (y, x) of the grid corner
+            cell_size (float): Width and height of a cell
+            out (array): Array to write the cell indices to (Default: new array)
+
+        Returns:
+            Tuple (counts, indices) with the number of cells per box (N,)
+            and the sorted flat cell indices of all boxes
+        """
+        ranges = Rasterization._cell_ranges(bounds, shape, origin, cell_size)
+        return ranges[2] * ranges[3], Rasterization._enumerate(ranges, shape, out=out)
+
+    def bins(self, patch):
+        """Flat bin indices of a patch (flat patch index)"""
+        return self.patch_indices[self.patch_indptr[patch]:self.patch_indptr[patch + 1]]
+
+    def patches(self, bin):
+        """Flat patch indices of a bin (flat bin index)"""
+        return self.bin_indices[self.bin_indptr[bin]:self.bin_indptr[bin + 1]]
+
+    def bins_of(self, patches):
+        """Get the bins of multiple patches
+
+        Args:
+            patches (array): Flat patch indices (N,)
+
+        Returns:
+            Tuple (indptr, indices) in CSR format with the bins of each patch
+        """
+        patches = np.asarray(patches, dtype=np.int64).ravel()
+        starts = self.patch_indptr[patches]
+        counts = self.patch_indptr[patches + 1] - starts
+
+        indptr = np.zeros(patches.size + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        offsets = np.repeat(starts - indptr[:-1], counts) + np.arange(indptr[-1])
+        return indptr, self.patch_indices[offsets]
+
+    #################
+    #   Appending   #
+    #################
+
+    def grow(self, shape, origin):
+        """Move the bins into a larger grid that contains the current one.
+        Both grids have to be aligned to the cell size.
+
+        Args:
+            shape (tuple): Shape of the new grid (V, U)
+            origin (tuple): Real world coordinates (y, x) of the new grid corner
+        """
+        dv = int(round((self.origin[0] - origin[0]) / self.cell_size))
+        du = int(round((self.origin[1] - origin[1]) / self.cell_size))
+        V, U = self.shape
+
+        assert dv >= 0 and du >= 0 and dv + V <= shape[0] and du + U <= shape[1], "The new grid has to contain the old one"
+
+        # Flat index in the new grid for every old bin (keeps the order)
+        v, u = np.divmod(np.arange(self.size, dtype=np.int64), U)
+        remap = (v + dv) * shape[1] + (u + du)
+
+        self.patch_indices = remap[self.patch_indices].astype(np.uint32)
+
+        counts = np.zeros(int(np.prod(shape)), dtype=np.int64)
+        counts[remap] = self.bin_counts
+        self.bin_indptr = np.zeros(counts.size + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.bin_indptr[1:])
+        
+        self.shape = tuple(int(s) for s in shape)
+        self.origin = origin
+
+    def set_bins(self, patches, counts, indices):
+        """Replace the bins of some patches and rebuild the bin --> patches direction
+
+        Args:
+            patches (array): Sorted flat patch indices (N,)
+            counts (array): Number of bins of each patch (N,)
+            indices (array): Flat bin indices of all patches
+        """
+        old_counts = np.diff(self.patch_indptr)
+        new_counts = old_counts.copy()
+        new_counts[patches] = counts
+
+        indptr = np.zeros(self.patch_indptr.size, dtype=np.int64)
+        np.cumsum(new_counts, out=indptr[1:])
+        result = np.empty(indptr[-1], dtype=np.uint32)
+
+        # Copy the bins of all other patches
+        keep = np.ones(old_counts.size, dtype=np.bool_)
+        keep[patches] = False
+        pair_patches = np.repeat(np.arange(old_counts.size), old_counts)
+        k = keep[pair_patches]
+        offsets = np.arange(self.patch_indices.size)[k] - self.patch_indptr[pair_patches[k]]
+        result[indptr[pair_patches[k]] + offsets] = self.patch_indices[k]
+
+        # Insert the new bins
+        pair_patches = np.repeat(patches, counts)
+        offsets = np.arange(pair_patches.size) - np.repeat(np.cumsum(counts) - counts, counts)
+        result[indptr[pair_patches] + offsets] = indices
+
+        self.patch_indptr, self.patch_indices = indptr, result
+        self.bin_indptr, self.bin_indices = self._transpose(self.patch_indptr, self.patch_indices, self.size)
+
+    def extend(self, other):
+        """Append the patches of another rasterization on the same grid"""
+        assert other.shape == self.shape, "Rasterizations need the same grid"
+        
+        offset = self.num_patches
+
+        # Patch --> bins
+        self.patch_indptr  = np.concatenate([self.patch_indptr, other.patch_indptr[1:] + self.patch_indptr[-1]])
+        self.patch_indices = np.concatenate([self.patch_indices, other.patch_indices])
+
+        # Bin --> patches: The new patches go after the old patches of every bin
+        bin_indptr  = self.bin_indptr + other.bin_indptr
+        bin_indices = np.empty(bin_indptr[-1], dtype=np.uint32)
+
+        old_bins = np.repeat(np.arange(self.size), self.bin_counts)
+        bin_indices[np.arange(self.bin_indices.size) + other.bin_indptr[old_bins]] = self.bin_indices
+
+        new_bins = np.repeat(np.arange(self.size), other.bin_counts)
+        bin_indices[np.arange(other.bin_indices.size) + self.bin_indptr[new_bins + 1]] = other.bin_indices + offset
+
+        self.bin_indptr, self.bin_indices = bin_indptr, bin_indices
+
+    #################
+    #      I/O      #
+    #################
+
+    def save(self, hf, key, start=None, end=None):
+        """Save the rasterization to the group "rasterization_<key>" (replaces old versions)"""
+        for name in ["bins_" + key, "rasterization_" + key, "rasterization_" + key + "_count"]:
+            if name in hf.keys():
+                logger.info("Deleting old %s from file" % name)
+                del hf[name]
+
+        logger.info("Writing rasterization_%s to file" % key)
+        g = hf.create_group("rasterization_" + key)
+        # The patch direction can be appended to when there are new frames
+        g.create_dataset("patch_indptr",  data=self.patch_indptr,  maxshape=(None,), chunks=(65536,))
+        g.create_dataset("patch_indices", data=self.patch_indices, maxshape=(None,), chunks=(262144,))
+        g.create_dataset("bin_indptr",    data=self.bin_indptr)
+        g.create_dataset("bin_indices",   data=self.bin_indices)
+
+        g.attrs["Shape"] = self.shape
+        g.attrs["Patches in bin index"] = self.num_patches
+        if self.cell_size is not None: g.attrs["Cell size"] = self.cell_size
+        if self.origin is not None:    g.attrs["Origin"] = self.origin
+
+        self._save_duration(g, start, end)
+
+    def append(self, hf, key, first, start=None, end=None):
+        """Append the bins of the patches from first on to the rasterization in the file.
+        The grid has to be unchanged. The bin --> patches direction of the appended
+        patches is not written but calculated when loading.
+
+        Args:
+            hf (h5py.File): File to write to
+            key (str): Key of the rasterization
+            first (int): First patch (flat index) that is not in the file yet
+        """
+        g = hf["rasterization_" + key]
+        assert tuple(g.attrs["Shape"]) == self.shape, "The grid changed, the rasterization has to be saved again"
+        assert g["patch_indptr"].shape[0] == first + 1, "The file has a different number of patches"
+
+        logger.info("Appending %i patches to rasterization_%s" % (self.num_patches - first, key))
+
+        indptr  = g["patch_indptr"]
+        indices = g["patch_indices"]
+        
+        stored = indptr[-1]
+        indptr.resize((self.num_patches + 1,))
+        indptr[first + 1:] = self.patch_indptr[first + 1:]
+        indices.resize((self.patch_indptr[-1],))
+        indices[stored:] = self.patch_indices[stored:]
+
+        self._save_duration(g, start, end)
+
+    @staticmethod
+    def _save_duration(g, start, end):
+        if start is not None and end is not None:
+            g.attrs["Start"] = start
+            g.attrs["End"] = end
+            g.attrs["Duration"] = end - start
+            g.attrs["Duration (formatted)"] = utils.format_duration(end - start)
+
+    @classmethod
+    def load(cls, hf, key):
+        """Load the rasterization with the given key from a file
+
+        Args:
+            hf (h5py.File): File to read from
+            key (str): Key of the rasterization (eg. "0.20" or "fake_0.20")
+
+        Returns:
+            A Rasterization or None if there is none in the file
+        """
+        g = hf.get("rasterization_" + key)
+
+        if isinstance(g, h5py.Group):
+            indptr  = np.array(g["patch_indptr"])
+            indices = np.array(g["patch_indices"])
+            n = g.attrs.get("Patches in bin index", indptr.size - 1)
+
+            rasterization = cls(g.attrs["Shape"],
+                                indptr[:n + 1], indices[:indptr[n]],
+                                np.array(g["bin_indptr"]), np.array(g["bin_indices"]),
+                                cell_size=g.attrs.get("Cell size", None),
+                                origin=g.attrs.get("Origin", None))
+
+            # Appended patches
+            if n < indptr.size - 1:
+                rasterization.extend(cls(rasterization.shape, indptr[n:] - indptr[n], indices[indptr[n]:]))
+            return rasterization
+
+        if isinstance(g, h5py.Dataset) and "bins_" + key in hf.keys():
+            # Old format with variable length datasets
+            logger.info("Converting rasterization_%s from the old format" % key)
+            bins = np.array(hf["bins_" + key]).ravel()
+            counts = np.fromiter((len(b) for b in bins), dtype=np.int64, count=bins.size)
+            indptr = np.zeros(bins.size + 1, dtype=np.int64)
+            np.cumsum(counts, out=indptr[1:])
+            indices = np.concatenate(bins) if indptr[-1] > 0 else np.zeros(0, dtype=np.uint32)
+            return cls(g.shape, indptr, indices)
+
+        return None
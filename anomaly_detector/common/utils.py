@@ -5,6 +5,8 @@ from common import logger
 import sys
 import time
 import signal
+import json
+import traceback
 import yaml
 
 import tensorflow as tf
@@ -149,6 +151,97 @@ def load_jpgs(filenames):
     return raw_dataset.map(_decode_function, num_parallel_calls=tf.data.experimental.AUTOTUNE) \
                       .prefetch(tf.data.experimental.AUTOTUNE)
 
+###############
+#   HDF5 IO   #
+###############
+
+def h5_memmap(dataset):
+    """Memory-map a HDF5 dataset (only possible if it is stored contiguously and uncompressed,
+    extract the features with chunk_bytes=0 for this, see FeatureExtractorBase.extract_dataset)
+    Args:
+        dataset (h5py.Dataset): Dataset to map
+
+    Returns:
+        np.memmap or None if the dataset can not be mapped
+    """
+    offset = dataset.id.get_offset()
+    if offset is None or dataset.chunks is not None or dataset.compression is not None:
+        return None
+    return np.memmap(dataset.file.filename, mode="r", dtype=dataset.dtype, shape=dataset.shape, offset=offset)
+
+CACHE_VERSION = 3
+
+def cache_path(filename):
+    """Directory of the cache next to a features file"""
+    return os.path.splitext(filename)[0] + ".cache"
+
+def load_cache(filename, mode="r"):
+    """Memory-map the cached patches of a features file (see save_cache)
+    Args:
+        filename (str): Features file (*.h5)
+        mode (str): Memory-map mode ("r" read-only, "c" copy on write)
+
+    Returns:
+        np.memmap (record array with one field per column) or None if there is no valid cache
+    """
+    path = cache_path(filename)
+    try:
+        with open(os.path.join(path, "manifest.json"), "r") as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    # The cache is only valid as long as the features file did not change
+    stat = os.stat(filename)
+    if manifest.get("Version") != CACHE_VERSION or \
+       manifest.get("mtime") != stat.st_mtime or \
+       manifest.get("Size") != stat.st_size:
+        logger.info("Cache of %s is outdated" % filename)
+        return None
+
+    try:
+        return np.load(os.path.join(path, manifest["File"]), mmap_mode=mode)
+    except (IOError, OSError, ValueError):
+        logger.warning("Could not read cache %s" % path)
+        return None
+
+def save_cache(filename, patches):
+    """Write the patches of a features file to a .npy file with a manifest, so they
+    can be memory-mapped (and shared between processes through the page cache)
+    Args:
+        filename (str): Features file (*.h5)
+        patches (np.ndarray): Record array with the patches
+    """
+    path = cache_path(filename)
+    manifest_file = os.path.join(path, "manifest.json")
+
+    s = time.time()
+    try:
+        if not os.path.exists(path):
+            os.mkdir(path)
+        elif os.path.exists(manifest_file):
+            # Invalidate the old cache first
+            os.remove(manifest_file)
+
+        np.save(os.path.join(path, "patches.npy"), np.asarray(patches))
+
+        stat = os.stat(filename)
+        manifest = {
+            "Version": CACHE_VERSION,
+            "mtime": stat.st_mtime,
+            "Size": stat.st_size,
+            "File": "patches.npy",
+            "Columns": list(patches.dtype.names)
+        }
+
+        # The manifest is written last, so an incomplete cache is never used
+        with open(manifest_file, "w") as f:
+            json.dump(manifest, f, indent=4)
+        logger.info("Writing cache %s: %f" % (path, time.time() - s))
+    except (IOError, OSError):
+        logger.warning("Could not write cache %s" % path)
+        logger.warning(traceback.format_exc())
+
 #################
 # Output helper #
 #################
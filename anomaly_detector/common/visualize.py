@@ -881,8 +881,7 @@ class Visualize(object):
 
         # Draw grid
         if self.show_grid:
-            relative_grid = self._ilu.absolute_to_relative(self._absolute_locations, frame.camera_locations[0, 0])
-            image_grid = self._ilu.relative_to_image(relative_grid, image.shape[0], image.shape[1])
+            image_grid = self._ilu.absolute_to_image(self._absolute_locations, frame.camera_locations[0, 0], image.shape[0], image.shape[1])
 
             in_image_filter = np.all([image_grid[...,0] > 0,
                                       image_grid[...,0] < image.shape[0],
@@ -905,9 +904,8 @@ class Visualize(object):
 
         # Draw receptive field of hovered patch
         if self.patches.contains_features and self._mouse_image_x > -1 and self._mouse_image_y > -1:
-            rf = self.patches.calculate_receptive_field(self._mouse_image_y + 0.5, self._mouse_image_x + 0.5,
-                                                        scale_y=image.shape[0] / float(self.patches.image_size),
-                                                        scale_x=image.shape[1] / float(self.patches.image_size))
+            scale = (image.shape[0] / float(self.patches.image_size), image.shape[1] / float(self.patches.image_size))
+            rf = self.patches.get_receptive_fields()[self._mouse_image_y, self._mouse_image_x] * scale
 
             cv2.rectangle(image, (int(rf[0][1]), int(rf[0][0])), (int(rf[2][1]), int(rf[2][0])), (0,0,255), 2)
 
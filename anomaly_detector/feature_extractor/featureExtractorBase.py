@@ -4,6 +4,11 @@ from common import utils, logger
 import sys
 import time
 import traceback
+import threading
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
 
 import tensorflow as tf
 import tensorflow_hub as hub
@@ -13,6 +18,238 @@ from tqdm import tqdm
 
 import consts
 
+class FeatureWriter(threading.Thread):
+    """Writes extracted batches to a HDF5 file in a separate thread, so inference and disk IO overlap.
+    The writer owns the file while it is running. Batches are passed through a bounded queue,
+    so the extraction blocks if the writer falls behind.
+    """
+    CHUNK_BYTES = 1024 * 1024 # Default target size of a chunk of the features dataset (1 MiB)
+
+    def __init__(self, hf, total, compression=None, compression_opts=None, queue_size=4, batch_size=1, chunk_bytes=None):
+        """Create a new writer (call start() to start writing)
+
+        Args:
+            hf (h5py.File): Output file
+            total (int): Number of items that will be written
+            compression (str): Output file compression
+            compression_opts (str): Compression level
+            queue_size (int): Maximum number of batches waiting to be written
+            batch_size (int): Number of items per batch (used for the chunk shape)
+            chunk_bytes (int): Target size of a chunk in bytes (Default: CHUNK_BYTES), 0 for no chunking
+                               (only possible without compression, needed for utils.h5_memmap)
+        """
+        threading.Thread.__init__(self, name="FeatureWriter")
+        self.daemon = True
+
+        self.hf               = hf
+        self.total            = total
+        self.compression      = compression
+        self.compression_opts = compression_opts
+        self.batch_size       = max(1, batch_size)
+        self.chunk_bytes      = self.CHUNK_BYTES if chunk_bytes is None else chunk_bytes
+
+        self.counter        = 0     # Number of items written
+        self.write_duration = 0     # Time spent writing
+        self.exception      = None  # Formatted exception of the writer thread
+
+        self._queue = Queue(maxsize=queue_size)
+
+    def put(self, features, times):
+        """Queue a batch for writing (blocks while the queue is full)
+
+        Args:
+            features (np.ndarray): Features of shape (batch size, ...)
+            times (np.ndarray): Times of shape (batch size,)
+        """
+        while True:
+            self._raise_if_failed()
+            try:
+                self._queue.put((features, times), timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def close(self):
+        """Wait until all batches are written"""
+        if self.is_alive():
+            self._queue.put(None)
+            self.join()
+        self._raise_if_failed()
+
+    @staticmethod
+    def get_chunk_shape(feature_shape, batch_size, chunk_bytes, total, itemsize=4):
+        """Get a chunk shape for a dataset of features that is written in batches and read in time ranges.
+        A chunk contains whole frames and is aligned to the batches, so every batch write
+        covers whole chunks (or a chunk covers whole batches).
+
+        Args:
+            feature_shape (tuple): Shape of the features of one frame
+            batch_size (int): Number of frames written at once
+            chunk_bytes (int): Target size of a chunk in bytes
+            total (int): Number of frames in the dataset
+            itemsize (int): Size of one value in bytes
+
+        Returns:
+            Chunk shape (frames, ) + feature_shape
+        """
+        frame_bytes = itemsize * int(np.prod(feature_shape))
+        frames = max(1, chunk_bytes // max(1, frame_bytes))
+
+        if frames >= batch_size:
+            # Multiple batches per chunk
+            frames = (frames // batch_size) * batch_size
+        else:
+            # Multiple chunks per batch
+            frames = max([d for d in range(1, frames + 1) if batch_size % d == 0])
+
+        return (int(max(1, min(frames, total))),) + tuple(feature_shape)
+
+    def _raise_if_failed(self):
+        if self.exception is not None:
+            raise RuntimeError("Writing the features failed:\n%s" % self.exception)
+
+    def run(self):
+        try:
+            feature_dataset = None # We don't know the feature shape yet
+            time_dataset    = self.hf.create_dataset("times",
+                                                     shape=(self.total,),
+                                                     dtype=np.uint64,
+                                                     compression=self.compression,
+                                                     compression_opts=self.compression_opts)
+            while True:
+                batch = self._queue.get()
+                if batch is None:
+                    break
+
+                features, times = batch
+                start = time.time()
+
+                if feature_dataset is None:
+                    # Create the array to store the features now
+                    if self.chunk_bytes > 0 or self.compression is not None:
+                        chunks = self.get_chunk_shape(features.shape[1:], self.batch_size, max(1, self.chunk_bytes), self.total)
+                    else:
+                        chunks = None # Contiguous
+                    feature_dataset = self.hf.create_dataset("features",
+                                                             shape=(self.total,) + features.shape[1:],
+                                                             chunks=chunks,
+                                                             dtype=np.float32,
+                                                             compression=self.compression,
+                                                             compression_opts=self.compression_opts)
+
+                # Save the features and their metadata to the arrays
+                feature_dataset[self.counter : self.counter + len(features)] = features
+                time_dataset[self.counter : self.counter + len(features)]    = times
+
+                self.counter += len(features)
+                self.write_duration += time.time() - start
+        except:
+            self.exception = traceback.format_exc()
+
+            # Unblock the extraction (it will see the exception)
+            while not self._queue.empty():
+                self._queue.get()
+
+class FeatureOutput(object):
+    """Output file of one extractor: The metadata, a FeatureWriter and the timings"""
+    def __init__(self, extractor, output_file, total, batch_size, compression=None, compression_opts=None,
+                 chunk_bytes=None, rdcc_nbytes=None, rdcc_nslots=None, **kwargs):
+        """Create the output file and start the writer (see FeatureExtractorBase.extract_dataset)"""
+        if output_file == "":
+            output_dir = consts.FEATURES_PATH
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            output_file = os.path.join(output_dir, extractor.NAME + ".h5")
+            logger.info("Output file set to %s" % output_file)
+
+        self.extractor   = extractor
+        self.output_file = output_file
+        self.total       = total
+        self.exception   = None # Formatted exception if the extraction failed
+
+        self.inference_duration = 0
+        self.transfer_duration  = 0
+
+        self.hf = h5py.File(output_file, "x", rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots)
+
+        # Add metadata to the output file
+        self.hf.attrs["Extractor"]           = extractor.NAME
+        self.hf.attrs["Batch size"]          = batch_size
+        self.hf.attrs["Compression"]         = str(compression)
+        self.hf.attrs["Compression options"] = str(compression_opts)
+        self.hf.attrs["Temporal batch size"] = extractor.TEMPORAL_BATCH_SIZE
+        self.hf.attrs["Receptive field"]     = extractor.RECEPTIVE_FIELD["size"]
+        self.hf.attrs["Image size"]          = extractor.IMG_SIZE
+
+        for key, value in kwargs.items():
+            if value is not None:
+                self.hf.attrs[key] = value
+        
+        computer_info = utils.getComputerInfo()
+        for key, value in computer_info.items():
+            self.hf.attrs[key] = value
+        
+        self.start = time.time()
+        self.hf.attrs["Start"] = self.start
+
+        # The features are written in a separate thread while the next batches are extracted
+        self.writer = FeatureWriter(self.hf, total, compression=compression, compression_opts=compression_opts,
+                                    batch_size=batch_size, chunk_bytes=chunk_bytes)
+        self.writer.start()
+
+    def extract(self, images, times):
+        """Extract the features of a batch and queue them for writing
+
+        Args:
+            images (tf.Tensor): Preprocessed batch of images
+            times (np.ndarray): Times of the images
+        """
+        # Extract features
+        s = time.time()
+        feature_batch = self.extractor.extract_batch(images) # This is where the magic happens
+        self.inference_duration += time.time() - s
+
+        # Copy to host memory
+        s = time.time()
+        feature_batch = feature_batch.numpy()
+        self.transfer_duration += time.time() - s
+
+        self.writer.put(feature_batch, times)
+
+    def close(self):
+        """Wait for the remaining batches, store the timings and close the file
+
+        Returns:
+            success (bool)
+        """
+        try:
+            # The writer owns the file until it is done
+            self.writer.close()
+        except:
+            if self.exception is None:
+                self.exception = traceback.format_exc()
+
+        if self.exception is not None:
+            logger.error("%s: %s" % (self.extractor.NAME, self.exception))
+            self.hf.attrs["Exception"] = self.exception
+
+        end = time.time()
+        self.hf.attrs["Inference duration"] = self.inference_duration
+        self.hf.attrs["Transfer duration"]  = self.transfer_duration
+        self.hf.attrs["Write duration"]     = self.writer.write_duration
+        self.hf.attrs["End"] = end
+        self.hf.attrs["Duration"] = end - self.start
+        self.hf.attrs["Duration (formatted)"] = utils.format_duration(end - self.start)
+        self.hf.attrs["Number of frames extracted"] = self.writer.counter
+        self.hf.attrs["Number of total frames"] = self.total
+        self.hf.close()
+
+        logger.info("%s - inference: %s, host transfer: %s, write: %s" % (self.extractor.NAME,
+                                                                          utils.format_duration(self.inference_duration),
+                                                                          utils.format_duration(self.transfer_duration),
+                                                                          utils.format_duration(self.writer.write_duration)))
+        return self.exception is None
+
 class FeatureExtractorBase(object):
     NAME       = property(lambda self: self.__class__.__name__.replace("FeatureExtractor", ""))
     
@@ -58,7 +295,10 @@ class FeatureExtractorBase(object):
             success (bool)
         """
 
-        dataset = patches.to_dataset()
+        if self.TEMPORAL_BATCH_SIZE > 1:
+            dataset = patches.to_temporal_dataset(self.TEMPORAL_BATCH_SIZE)
+        else:
+            dataset = patches.to_dataset()
         total = patches.shape[0]
 
         return self.extract_dataset(dataset, total, **kwargs)
@@ -75,7 +315,8 @@ class FeatureExtractorBase(object):
         dataset, total = utils.load_dataset(files)
         return self.extract_dataset(dataset, total, **kwargs)
     
-    def extract_dataset(self, dataset, total, output_file="", batch_size=None, compression=None, compression_opts=None, **kwargs):
+    def extract_dataset(self, dataset, total, output_file="", batch_size=None, compression=None, compression_opts=None,
+                        chunk_bytes=None, rdcc_nbytes=None, rdcc_nslots=None, **kwargs):
         """Loads a set of files, extracts the features and saves them to file
         Args:
             dataset (tf.data.Dataset): Dataset containing the input data
@@ -84,143 +325,108 @@ class FeatureExtractorBase(object):
             batch_size (str): Size of image batches fed to the extractor. Set to 0 for no batching. (Default: self.BATCH_SIZE)
             compression (str): Output file compression, set to None for no compression (Default: None), lzf is feasable, gzip can be extremely slow combined with HDF5
             compression_opts (str): Compression level, set to None for no compression (Default: None)
+            chunk_bytes (int): Target size of a chunk of the features, the chunks are aligned to the batches
+                               (Default: FeatureWriter.CHUNK_BYTES), set to 0 for a contiguous dataset
+                               (needed to memory-map the features, eg. PatchArray(filename, lazy=True))
+            rdcc_nbytes (int): Size of the HDF5 chunk cache in bytes (Default: HDF5 default)
+            rdcc_nslots (int): Number of slots in the HDF5 chunk cache (Default: HDF5 default)
             **kwargs: Additional arguments will be saved to the output file as h5 attributes
 
         Returns:
             success (bool)
         """
+        return FeatureExtractorBase.extract_multiple([self], dataset, total, output_files=[output_file], batch_size=batch_size,
+                                                     compression=compression, compression_opts=compression_opts,
+                                                     chunk_bytes=chunk_bytes, rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots,
+                                                     **kwargs)[0]
+
+    @staticmethod
+    def extract_multiple(extractors, dataset, total, output_files=None, batch_size=None, **kwargs):
+        """Extracts the features of multiple extractors in a single pass over the dataset,
+        so every frame is only read and decoded once. The extractors are grouped by their
+        preprocessing (format_image and IMG_SIZE), all extractors of a group get the same
+        preprocessed batches. Every extractor writes its own output file.
 
-        if output_file == "":
-            output_dir = consts.FEATURES_PATH
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            output_file = os.path.join(output_dir, self.NAME + ".h5")
-            logger.info("Output file set to %s" % output_file)
-        
-        if batch_size is None:
-            batch_size = self.BATCH_SIZE
+        Args:
+            extractors (list): Feature extractors (without temporal batches, see TEMPORAL_BATCH_SIZE)
+            dataset (tf.data.Dataset): Dataset containing the input data
+            total (int): Number of items in Dataset
+            output_files (list): Output file of every extractor (Default: <FEATURES_PATH>/<NAME>.h5)
+            batch_size (int): Size of image batches fed to the extractors. Set to 0 for no batching.
+                              (Default: The smallest BATCH_SIZE of the extractors)
+            For **kwargs see extract_dataset
 
-        # Preprocess images
-        dataset = dataset.map(lambda image, time: (self.format_image(image), time),
-                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        Returns:
+            List with the success (bool) of every extractor
+        """
+        if output_files is None:
+            output_files = [""] * len(extractors)
+
+        if batch_size is None:
+            batch_size = min([e.BATCH_SIZE for e in extractors])
+
+        # Group the extractors by preprocessing
+        groups = list() # [(key, [extractor indices])]
+        for i, e in enumerate(extractors):
+            format_image = type(e).format_image
+            key = (e.IMG_SIZE, getattr(format_image, "__func__", format_image))
+            for k, indices in groups:
+                if k == key:
+                    indices.append(i)
+                    break
+            else:
+                groups.append((key, [i]))
+
+        formats = [extractors[indices[0]].format_image for _, indices in groups]
 
         # Call internal transformations (eg. temporal windowing for 3D networks)
-        # dataset, total = self.__transform_dataset__(dataset, total)
+        if len(set([e.TEMPORAL_BATCH_SIZE for e in extractors])) > 1:
+            raise ValueError("All extractors of a pass need the same temporal batch size.")
+        dataset, total = extractors[0].__transform_dataset__(dataset, total)
+
+        # Preprocess images (once per group)
+        dataset = dataset.map(lambda image, time: (tuple(f(image) for f in formats), time),
+                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
         # Get batches (seems to be better performance wise than extracting individual images)
         if batch_size > 0:
             dataset = dataset.batch(batch_size)
 
         # IO stuff
-        hf = h5py.File(output_file, "x")
-    
+        outputs = list()
+        for e, output_file in zip(extractors, output_files):
+            try:
+                outputs.append(FeatureOutput(e, output_file, total, batch_size, **kwargs))
+            except:
+                logger.error("%s: %s" % (e.NAME, traceback.format_exc()))
+                outputs.append(None)
+
         try:
-            # Add metadata to the output file
-            hf.attrs["Extractor"]           = self.NAME
-            hf.attrs["Batch size"]          = batch_size
-            hf.attrs["Compression"]         = str(compression)
-            hf.attrs["Compression options"] = str(compression_opts)
-            hf.attrs["Temporal batch size"] = self.TEMPORAL_BATCH_SIZE
-            hf.attrs["Receptive field"]     = self.RECEPTIVE_FIELD["size"]
-            hf.attrs["Image size"]          = self.IMG_SIZE
-
-            for key, value in kwargs.items():
-                if value is not None:
-                    hf.attrs[key] = value
-            
-            computer_info = utils.getComputerInfo()
-            for key, value in computer_info.items():
-                hf.attrs[key] = value
-            
-            start = time.time()
-            counter = 0
-
-            hf.attrs["Start"] = start
-            
-            # Create arrays to store output
-            feature_dataset = None # We don't know the feature shape yet
-            time_dataset    = hf.create_dataset("times",
-                                                shape=(total,),
-                                                dtype=np.uint64,
-                                                compression=compression,
-                                                compression_opts=compression_opts)
-            
             # Loop over the dataset
-            with tqdm(desc="Extracting features (batch size: %i)" % batch_size, total=total, file=sys.stderr) as pbar:
+            with tqdm(desc="Extracting features (batch size: %i, extractors: %i)" % (batch_size, len(extractors)), total=total, file=sys.stderr) as pbar:
                 for batch in dataset:
-                    # Extract features
-                    feature_batch = self.extract_batch(batch[0]) # This is where the magic happens
-
-                    current_batch_size = len(feature_batch)
-
-                    if feature_dataset is None:
-                        # Create the array to store the features now
-                        feature_dataset = hf.create_dataset("features",
-                                                            shape=(total,) + tuple(feature_batch[0].shape),
-                                                            chunks=(1,) + tuple(feature_batch[0].shape),
-                                                            dtype=np.float32,
-                                                            compression=compression,
-                                                            compression_opts=compression_opts)
-
-                    # Save the features and their metadata to the arrays
-                    feature_dataset[counter : counter + current_batch_size] = feature_batch.numpy()
-                    time_dataset[counter : counter + current_batch_size]    = batch[1].numpy()
-
-                    # Count and update progress bar
-                    counter += current_batch_size
-                    pbar.update(n=current_batch_size)
-
-            ## Variant where we first store everything in RAM
-            # feature_dataset = None # We don't know the feature shape yet
-            # time_dataset    = np.empty((total,),   dtype=np.uint64)
-            
-            # # Loop over the dataset
-            # with tqdm(desc="Extracting features (batch size: %i)" % batch_size, total=total, file=sys.stderr) as pbar:
-            #     for batch in dataset:
-            #         # Extract features
-            #         feature_batch = self.extract_batch(batch[0]) # This is where the magic happens
-
-            #         current_batch_size = len(feature_batch)
-
-            #         if feature_dataset is None:
-            #             # Create the array to store the features now
-            #             feature_dataset = np.empty((total,) + feature_batch[0].shape, dtype=np.float32)
-
-            #         # Save the features and their metadata to the arrays
-            #         feature_dataset[counter : counter + current_batch_size] = feature_batch.numpy()
-            #         time_dataset[counter : counter + current_batch_size]    = batch[1].numpy()
-
-            #         # Count and update progress bar
-            #         counter += current_batch_size
-            #         pbar.update(n=current_batch_size)
-
-            # # Save arrays to file
-            # hf.create_dataset("features",
-            #                   data=feature_dataset,
-            #                   dtype=np.float32,
-            #                   compression=compression,
-            #                   compression_opts=compression_opts)
-            # hf.create_dataset("times",
-            #                   data=time_dataset,
-            #                   chunks=(1,) + tuple(feature_batch[0].shape),
-            #                   dtype=np.uint64,
-            #                   compression=compression,
-            #                   compression_opts=compression_opts)
-        except:
-            exc = traceback.format_exc()
-            logger.error(exc)
-            hf.attrs["Exception"] = exc
-            return False
+                    time_batch = batch[1].numpy()
+
+                    for g, (_, indices) in enumerate(groups):
+                        for i in indices:
+                            if outputs[i] is None or outputs[i].exception is not None:
+                                continue
+                            try:
+                                outputs[i].extract(batch[0][g], time_batch)
+                            except (KeyboardInterrupt, SystemExit):
+                                raise
+                            except:
+                                outputs[i].exception = traceback.format_exc()
+
+                    if all([o is None or o.exception is not None for o in outputs]):
+                        break
+
+                    # Update progress bar
+                    pbar.update(n=np.size(time_batch))
         finally:
-            end = time.time()
-            hf.attrs["End"] = end
-            hf.attrs["Duration"] = end - start
-            hf.attrs["Duration (formatted)"] = utils.format_duration(end - start)
-            hf.attrs["Number of frames extracted"] = counter
-            hf.attrs["Number of total frames"] = total
-            hf.close()
-
-        return True
+            success = [o is not None and o.close() for o in outputs]
+
+        return success
 
     ########################
     #      Utilities       #
@@ -34,6 +34,11 @@ class FeatureExtractorC3D(FeatureExtractorBase):
         return image
 
     def __transform_dataset__(self, dataset, total):
+        """Get temporal windows of TEMPORAL_BATCH_SIZE frames. Datasets that already contain
+        windows (eg. PatchArray.to_temporal_dataset, which respects the rounds) are used as they are."""
+        if len(dataset.element_spec[0].shape) == 4:
+            return dataset, total
+
         total = total - self.TEMPORAL_BATCH_SIZE + 1
 
         temporal_image_windows = dataset.map(lambda image, *args: image).window(self.TEMPORAL_BATCH_SIZE, 1, 1, True)
@@ -86,4 +91,4 @@ if __name__ == "__main__":
 
     patches = patches[f]
 
-    extractor.extract_dataset(patches.to_temporal_dataset(), patches.shape[0])
\ No newline at end of file
+    extractor.extract_frame_array(patches)
\ No newline at end of file
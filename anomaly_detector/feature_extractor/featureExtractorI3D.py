@@ -20,6 +20,11 @@ class FeatureExtractorI3D(FeatureExtractorBase):
         self.model = tf.keras.Model(inputs=inputs, outputs=layer)
     
     def __transform_dataset__(self, dataset, total):
+        """Get temporal windows of TEMPORAL_BATCH_SIZE frames. Datasets that already contain
+        windows (eg. PatchArray.to_temporal_dataset) are used as they are."""
+        if len(dataset.element_spec[0].shape) == 4:
+            return dataset, total
+
         total = total - self.TEMPORAL_BATCH_SIZE + 1
 
         temporal_image_windows = dataset.map(lambda image, *args: image).window(self.TEMPORAL_BATCH_SIZE, 1, 1, True)
@@ -27,7 +32,12 @@ class FeatureExtractorI3D(FeatureExtractorBase):
         return tf.data.Dataset.zip((temporal_image_windows, matching_meta_stuff)).map(lambda image, meta: (image,) + meta), total
 
     def extract_batch(self, batch):
-        tensor = tf.constant(list(batch.as_numpy_iterator()))
+        if isinstance(batch, tf.data.Dataset):
+            tensor = tf.constant(list(batch.as_numpy_iterator()))
+        else:
+            tensor = batch
+        if tensor.ndim == 4:
+            tensor = tf.expand_dims(tensor, axis=0)
         return self.model(tensor)
 
 # Only for tests
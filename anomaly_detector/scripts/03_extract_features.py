@@ -16,6 +16,10 @@ parser.add_argument("--files", metavar="F", dest="files", type=str, nargs='*', d
 parser.add_argument("--extractor", metavar="EXT", dest="extractor", nargs='*', type=str,
                     help="Extractor name. Leave empty for all extractors (default: \"\")")
 
+parser.add_argument("--fan_out", metavar="N", dest="fan_out", type=int, default=1,
+                    help="Number of extractors fed from a single pass over the images.\n"
+                         "Every frame is only decoded once per pass (default: 1)")
+
 args = parser.parse_args()
 
 import os
@@ -83,30 +87,41 @@ def extract_features():
     dataset_3D = patches.to_temporal_dataset(16)
     total = patches.shape[0]
 
-    # Add progress bar if multiple extractors
-    if len(args.extractor) > 1:
-        args.extractor = tqdm(args.extractor, desc="Extractors", file=sys.stderr)
+    # Extractors with temporal batches need their own dataset
+    extractors_3D = [e for e in args.extractor if getattr(module, e).TEMPORAL_BATCH_SIZE > 1]
+    extractors_2D = [e for e in args.extractor if getattr(module, e).TEMPORAL_BATCH_SIZE <= 1]
+
+    # Group the 2D extractors into passes of up to args.fan_out extractors
+    fan_out = max(args.fan_out, 1)
+    passes = [[e] for e in extractors_3D] + [extractors_2D[i:i + fan_out] for i in range(0, len(extractors_2D), fan_out)]
 
-    for extractor_name in args.extractor:
+    # Add progress bar if multiple passes
+    if len(passes) > 1:
+        passes = tqdm(passes, desc="Extractors", file=sys.stderr)
+
+    for extractor_names in passes:
         try:
-            bs = getattr(module, extractor_name).TEMPORAL_BATCH_SIZE
-            shape = getattr(module, extractor_name).OUTPUT_SHAPE
             # if np.prod(shape) > 300000:
             #     logger.warning("Skipping %s (output too big)" % extractor_name)
             #     continue
 
-            logger.info("Instantiating %s" % extractor_name)
-            extractor = getattr(module, extractor_name)()
-            # Get an instance
-            if bs > 1:
-                extractor.extract_dataset(dataset_3D, total)
+            # Get instances
+            extractors = list()
+            for extractor_name in extractor_names:
+                logger.info("Instantiating %s" % extractor_name)
+                extractors.append(getattr(module, extractor_name)())
+
+            if extractors[0].TEMPORAL_BATCH_SIZE > 1:
+                extractors[0].extract_dataset(dataset_3D, total)
+            elif len(extractors) == 1:
+                extractors[0].extract_dataset(dataset, total)
             else:
-                extractor.extract_dataset(dataset, total)
+                module.FeatureExtractorBase.extract_multiple(extractors, dataset, total)
         except KeyboardInterrupt:
             logger.info("Terminated by CTRL-C")
             return
         except:
-            logger.error("%s: %s" % (extractor_name, traceback.format_exc()))
+            logger.error("%s: %s" % (", ".join(extractor_names), traceback.format_exc()))
 
 if __name__ == "__main__":
     extract_features()
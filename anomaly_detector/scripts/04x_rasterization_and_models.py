@@ -10,6 +10,8 @@
 # and only seem to use one core.                                                                #
 # You can call *04_rasterization_and_models_parallel.sh* instead for to run multiple            #
 # instances of this script, which will then utilize more CPU cores. But beware heyvy RAM use!   #
+# (--chunk_size streams the features from the file for the SVG and the mahalanobis distances)   #
+# (--n_jobs rasterizes with multiple processes)                                                 #
 #################################################################################################
 
 
@@ -27,6 +29,13 @@ parser.add_argument("--index", metavar="I", dest="index", type=int, default=None
 parser.add_argument("--total", metavar="T", dest="total", type=int, default=None,
                     help="")
 
+parser.add_argument("--chunk_size", metavar="C", dest="chunk_size", type=int, default=None,
+                    help="Stream the features in chunks of C frames when generating the SVG and\n"
+                         "calculating the mahalanobis distances (default: None, everything in RAM)")
+
+parser.add_argument("--n_jobs", metavar="J", dest="n_jobs", type=int, default=1,
+                    help="Number of processes used for rasterization (default: 1, -1: all cores)")
+
 args = parser.parse_args()
 
 import os
@@ -82,9 +91,8 @@ def calculate_locations():
                 # Calculate and save the locations
                 for fake in [False]:
                     patches.calculate_patch_locations(fake=fake)
+                    patches.calculate_rasterizations([0.2, 0.5], fake=fake, n_jobs=args.n_jobs)
                     for cell_size in [0.2, 0.5]:
-                        patches.calculate_rasterization(cell_size, fake=fake)
-
                         models.append(AnomalyModelSpatialBinsBase(AnomalyModelSVG, cell_size=cell_size, fake=fake))
                         # models.append(AnomalyModelSpatialBinsBase(lambda: AnomalyModelBalancedDistributionSVG(initial_normal_features=10, threshold_learning=threshold_learning, pruning_parameter=0.5), cell_size=cell_size, fake=fake))
 
@@ -102,12 +110,12 @@ def calculate_locations():
                             model, mdist = m.is_in_file(features_file)
 
                             if not model:
-                                m.load_or_generate(patches, silent=True)
+                                m.load_or_generate(patches, silent=True, chunk_size=args.chunk_size)
                             elif not mdist:
                                 logger.info("Model already calculated")
                                 m.load_from_file(features_file)
                                 m.patches = patches
-                                m.calculate_mahalanobis_distances()
+                                m.calculate_mahalanobis_distances(chunk_size=args.chunk_size)
                             else:
                                 logger.info("Model and mahalanobis distances already calculated")
 
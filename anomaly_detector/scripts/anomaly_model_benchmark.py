@@ -27,9 +27,33 @@ from glob import glob
 
 import numpy as np
 import csv
+import resource
+import multiprocessing
 from tqdm import tqdm
 from anomaly_model import AnomalyModelSVG, AnomalyModelBalancedDistribution, AnomalyModelBalancedDistributionSVG, AnomalyModelSpatialBinsBase
 
+def _peak_rss(fn):
+    """Run fn in a new process and return how much its peak RSS grew (in MB)"""
+    def _run(queue):
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn()
+        queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run, args=(queue,))
+    process.start()
+    peak = queue.get()
+    process.join()
+    return peak / 1024.0 # ru_maxrss is in KB
+
+def _load_frame_metadata(features_file):
+    """Open the file without features (the metadata is stored once per frame)"""
+    PatchArray(features_file, features=False)
+
+def _load_patch_metadata(features_file):
+    """Open the file without features and copy the metadata to every patch (like before the frame table)"""
+    patches = PatchArray(features_file, features=False)
+    per_patch = [np.array(patches[n]) for n in patches.frame_metadata.dtype.names]
+
 def anomaly_model_benchmark():
     ################
     #  Parameters  #
@@ -59,7 +83,7 @@ def anomaly_model_benchmark():
     with tqdm(total=len(files), file=sys.stderr, desc="Calculating SVG") as pbar:
         for features_file in files:
             # Load the file
-            patches = PatchArray(features_file)
+            patches = PatchArray(features_file, cache=True)
             m = AnomalyModelSVG()
             m.load_or_generate(patches, silent=True)
             pbar.update()
@@ -84,8 +108,14 @@ def anomaly_model_benchmark():
                     continue
 
 
+                # Peak memory of the metadata stored per frame and per patch
+                for name, fn in (("Frame metadata", _load_frame_metadata), ("Metadata per patch", _load_patch_metadata)):
+                    peak = _peak_rss(lambda: fn(features_file))
+                    logger.info("%-40s (%s): %.1f MB peak RSS" % (extractor_name, name, peak))
+                    result["%s (Peak RSS MB)" % name] = peak
+
                 # Load the file
-                patches = PatchArray(features_file)
+                patches = PatchArray(features_file, cache=True)
                 
                 models = [AnomalyModelSVG()]
 
@@ -114,6 +144,9 @@ def anomaly_model_benchmark():
                             log("%s (Maha per patch)" % m.NAME, np.array(timeit.repeat(lambda: m.__mahalanobis_distance__(patches[0, 0, 0]), number=1, repeat=10)))
                             log("%s (Maha per frame)" % m.NAME, np.array(timeit.repeat(lambda: _evaluate_frame(), number=1, repeat=10)) / float(patches.shape[0]))
 
+                            m.patches = patches
+                            log("%s (Maha per frame, batch)" % m.NAME, np.array(timeit.repeat(lambda: m._mahalanobis_distances(patches.features, slice(None)), number=1, repeat=10)) / float(patches.shape[0]))
+
                         except (KeyboardInterrupt, SystemExit):
                             raise
                         except:
@@ -28,6 +28,22 @@ parser.add_argument("--extract_single_repeat", metavar="B", dest="extract_single
 parser.add_argument("--extract_batch_repeat", metavar="B", dest="extract_batch_repeat", type=int, default=10,
                     help="Number of batch extraction repetitions. (default: 10)")
 
+parser.add_argument("--layout", dest="layout", action="store_true",
+                    help="Benchmark the HDF5 layout of the features (write and read throughput per chunk size)\n"
+                         "with random features of the extractors' output shapes instead of the extractors")
+
+parser.add_argument("--layout_frames", metavar="N", dest="layout_frames", type=int, default=2048,
+                    help="Number of frames written per layout. (default: 2048)")
+
+parser.add_argument("--layout_chunk_bytes", metavar="C", dest="layout_chunk_bytes", nargs="*", type=int, default=[1, 256*1024, 1024*1024, 4*1024*1024, 0],
+                    help="Target chunk sizes in bytes (1: one frame per chunk, 0: contiguous). (default: [1, 256 KiB, 1 MiB, 4 MiB, 0])")
+
+parser.add_argument("--layout_read_frames", metavar="R", dest="layout_read_frames", type=int, default=64,
+                    help="Number of frames per time range read. (default: 64)")
+
+parser.add_argument("--rdcc_nbytes", metavar="B", dest="rdcc_nbytes", type=int, default=None,
+                    help="Size of the HDF5 chunk cache in bytes. (default: HDF5 default)")
+
 args = parser.parse_args()
 
 import os
@@ -36,11 +52,14 @@ import sys
 from datetime import datetime
 import inspect
 import traceback
+import time
 import timeit
+import tempfile
 from glob import glob
 
 import numpy as np
 import csv
+import h5py
 import tensorflow as tf
 from tqdm import tqdm
 import subprocess
@@ -165,5 +184,91 @@ def feature_extractor_benchmark():
         writer.writerow(result)
         csvfile.close()
 
+def layout_benchmark():
+    """Compare the write and read throughput of the features dataset for different chunk layouts.
+    The files are read right after writing, so the reads will mostly be served from the page cache
+    and only show the overhead of the layout (chunk lookups, copies), not the disk speed.
+    """
+    from feature_extractor.featureExtractorBase import FeatureWriter
+
+    if args.output is None:
+        filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), datetime.now().strftime("%Y_%m_%d_%H_%M_benchmark_layout.csv"))
+    else:
+        filename = args.output
+    
+    write_header = not os.path.exists(filename)
+
+    if args.extractor is None:
+        extractor_names = map(lambda e: e[0], inspect.getmembers(feature_extractor, inspect.isclass))
+        args.extractor = filter(lambda f: f != "FeatureExtractorBase", extractor_names)
+
+    module = __import__("feature_extractor")
+    n = args.layout_frames
+
+    with open(filename, "a") as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=["Extractor", "Layout", "Chunk shape", "Write (MB/s)", "Read range (MB/s)", "Read frame (ms)"])
+
+        if write_header:
+            writer.writeheader()
+
+        for extractor_name in tqdm(args.extractor, desc="Benchmarking layouts", file=sys.stderr):
+            _class = getattr(module, extractor_name)
+            batch_size = _class.BATCH_SIZE
+
+            features = np.random.rand(*((n,) + tuple(_class.OUTPUT_SHAPE))).astype(np.float32)
+            times = np.arange(n, dtype=np.uint64)
+            size = features.nbytes / 1e6
+
+            for chunk_bytes in args.layout_chunk_bytes:
+                fd, tmp = tempfile.mkstemp(suffix=".h5")
+                os.close(fd)
+                os.remove(tmp)
+
+                try:
+                    # Write like FeatureExtractorBase.extract_dataset
+                    start = time.time()
+                    hf = h5py.File(tmp, "x", rdcc_nbytes=args.rdcc_nbytes)
+                    feature_writer = FeatureWriter(hf, n, batch_size=batch_size, chunk_bytes=chunk_bytes)
+                    feature_writer.start()
+                    for i in range(0, n, batch_size):
+                        feature_writer.put(features[i:i + batch_size], times[i:i + batch_size])
+                    feature_writer.close()
+                    chunks = hf["features"].chunks
+                    hf.close()
+                    write = time.time() - start
+
+                    with h5py.File(tmp, "r", rdcc_nbytes=args.rdcc_nbytes) as hf:
+                        dataset = hf["features"]
+
+                        # Time ranges (eg. PatchArray, streamed mahalanobis distances)
+                        start = time.time()
+                        for i in range(0, n, args.layout_read_frames):
+                            dataset[i:i + args.layout_read_frames]
+                        read_range = time.time() - start
+
+                        # Single frames in random order (eg. Visualize)
+                        indices = np.random.randint(0, n, size=100)
+                        start = time.time()
+                        for i in indices:
+                            dataset[i]
+                        read_frame = (time.time() - start) / len(indices)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+
+                layout = "Contiguous" if chunks is None else "Chunked (%i frames)" % chunks[0]
+                logger.info("%-40s %-25s write: %8.1f MB/s, read range: %8.1f MB/s, read frame: %.3f ms" % (extractor_name, layout,
+                            size / write, size / read_range, read_frame * 1000))
+
+                writer.writerow({"Extractor": extractor_name.replace("FeatureExtractor", ""),
+                                 "Layout": layout,
+                                 "Chunk shape": str(chunks),
+                                 "Write (MB/s)": size / write,
+                                 "Read range (MB/s)": size / read_range,
+                                 "Read frame (ms)": read_frame * 1000})
+
 if __name__ == "__main__":
-    feature_extractor_benchmark()
\ No newline at end of file
+    if args.layout:
+        layout_benchmark()
+    else:
+        feature_extractor_benchmark()
\ No newline at end of file
@@ -17,7 +17,7 @@ args = parser.parse_args()
 
 import os
 import time
-from common import utils, logger, PatchArray, ImageLocationUtility
+from common import utils, logger, PatchArray, ImageLocationUtility, Rasterization
 import sys
 from datetime import datetime
 import inspect
@@ -92,8 +92,7 @@ def rasterization_benchmark():
                     
                     relative_locations = patches._image_to_relative(image_locations)
                     
-                    for i in tqdm(range(patches[key].shape[0]), desc="Calculating locations", file=sys.stderr):
-                        patches[key][i] = patches._relative_to_absolute(relative_locations, patches[i, 0, 0].camera_locations)
+                    patches._corners(fake)[...] = patches._relative_to_absolute(relative_locations, patches.camera_locations[:, 0, 0])
 
                     end = time.time()
 
@@ -106,7 +105,7 @@ def rasterization_benchmark():
                     # Time individual blocks
                     log("RF (img) [f: %s]" % fake,      np.array(timeit.repeat(lambda: patches._get_receptive_fields(fake=fake), number=1, repeat=5)))
                     log("RF --> rel [f: %s]" % fake, np.array(timeit.repeat(lambda: patches._image_to_relative(image_locations), number=1, repeat=5)))
-                    log("RF --> abs [f: %s]" % fake, np.array(timeit.repeat(lambda: patches._relative_to_absolute(relative_locations, patches[0, 0, 0].camera_locations), number=1, repeat=10)))
+                    log("RF --> abs (all) [f: %s]" % fake, np.array(timeit.repeat(lambda: patches._relative_to_absolute(relative_locations, patches.camera_locations[:, 0, 0]), number=1, repeat=10)))
 
                     #####################
                     #   RASTERIZATION   #
@@ -115,7 +114,7 @@ def rasterization_benchmark():
                         key = "%.2f" % cell_size
                         if fake: key = "fake_" + key
 
-                        grid, shape = patches._calculate_grid(cell_size, fake=fake)
+                        shape, origin = patches._calculate_grid(cell_size, fake=fake)
 
                         rf_factor = patches.receptive_field[0] / patches.image_size
 
@@ -123,20 +122,24 @@ def rasterization_benchmark():
 
                         start = time.time()
                         
-                        # Get the corresponding bin for every feature
-                        Parallel(n_jobs=2, prefer="threads")(
-                            delayed(patches._bin)(i, grid, shape, rf_factor, key, fake) for i in tqdm(range(patches.shape[0]), desc="Calculating bins", file=sys.stderr))
+                        # Get the corresponding bins for every feature
+                        counts, indices = patches._bin(0, patches.shape[0], shape, origin, cell_size, rf_factor, fake)
+
+                        indptr = np.zeros(counts.size + 1, dtype=np.int64)
+                        np.cumsum(counts, out=indptr[1:])
+                        rasterization = Rasterization(shape, indptr, indices, cell_size=cell_size, origin=origin)
 
                         end = time.time()
 
-                        patches._save_rasterization(key, grid, shape, start, end)
+                        patches._save_rasterization(key, rasterization, start, end)
                         
                         patches.contains_bins[key] = True
-                        patches.rasterizations[key] = np.vectorize(lambda b: b.patches, otypes=[object])(patches.rasterizations[key])
+                        patches.rasterizations[key] = rasterization
 
                         # Time individual blocks
                         log("Grid [%.2f, f: %s]" % (cell_size, fake), np.array(timeit.repeat(lambda: patches._calculate_grid(cell_size, fake=fake), number=1, repeat=3)))
-                        log("Bins [%.2f, f: %s]" % (cell_size, fake), np.array(timeit.repeat(lambda: patches._bin(0, grid, shape, rf_factor, key, fake), number=1, repeat=3)))
+                        log("Bins [%.2f, f: %s]" % (cell_size, fake), np.array(timeit.repeat(lambda: patches._bin(0, 1, shape, origin, cell_size, rf_factor, fake), number=1, repeat=3)))
+                        log("Bins (all) [%.2f, f: %s]" % (cell_size, fake), np.array(timeit.repeat(lambda: patches._bin(0, patches.shape[0], shape, origin, cell_size, rf_factor, fake), number=1, repeat=3)))
 
                 if writer is None:
                     writer = csv.DictWriter(csvfile, fieldnames=result.keys())
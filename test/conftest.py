@@ -0,0 +1,71 @@
+import os
+import sys
+import types
+
+import numpy as np
+import h5py
+import pytest
+
+# The modules import each other relative to anomaly_detector (eg. "from common import utils")
+# and implicitly relative to their package (eg. "from patchArray import PatchArray")
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "anomaly_detector")
+for path in ("anomaly_model", "common", ""):
+    sys.path.insert(0, os.path.join(ROOT, path))
+
+# consts.py is the local configuration and not part of the repository
+try:
+    import consts
+except ImportError:
+    consts = types.ModuleType("consts")
+    consts.IMAGES_PATH   = ""
+    consts.FEATURES_PATH = ""
+    consts.FEATURES_FILE = ""
+    consts.EXTRACT_FILES = []
+    consts.DEFAULT_BATCH_SIZE = 32
+    sys.modules["consts"] = consts
+
+FRAMES = 50
+GRID   = (3, 4)
+DIMS   = 8
+
+@pytest.fixture
+def features_file(tmp_path):
+    """A small features file (50 frames, 3 x 4 patches, 8 dimensions) and the metadata of 60 frames
+
+    Returns:
+        (filename, images_path, features, metadata)
+    """
+    from common import PatchArray
+
+    rng = np.random.RandomState(0)
+    n = FRAMES + 10
+
+    v3 = [("x", np.float32), ("y", np.float32), ("z", np.float32)]
+    camera_locations = np.zeros(n, dtype=[("translation", v3), ("rotation", v3 + [("w", np.float32)])])
+    camera_locations["translation"]["x"] = np.arange(n)
+
+    metadata = {
+        "times":            np.arange(n, dtype=np.uint64) * 10,
+        "labels":           rng.randint(0, 3, n).astype(np.uint8),
+        "directions":       rng.randint(0, 3, n).astype(np.uint8),
+        "stop":             np.zeros(n, dtype=np.uint8),
+        "round_numbers":    np.repeat([1, 2], n // 2).astype(np.uint8),
+        "camera_locations": camera_locations
+    }
+
+    with h5py.File(str(tmp_path / "metadata_cache.h5"), "w") as hf:
+        for key, value in metadata.items():
+            hf.create_dataset(key, data=value)
+
+    # The features only cover a part of the frames (like C3D)
+    features = rng.rand(FRAMES, GRID[0], GRID[1], DIMS).astype(np.float32)
+    filename = str(tmp_path / "features.h5")
+    with h5py.File(filename, "w") as hf:
+        hf.create_dataset("times", data=metadata["times"][5:FRAMES + 5])
+        hf.create_dataset("features", data=features)
+        hf.attrs["Receptive field"] = (100, 100)
+        hf.attrs["Image size"] = 224
+
+    yield filename, str(tmp_path), features, {k: v[5:FRAMES + 5] for k, v in metadata.items()}
+
+    PatchArray.root = None
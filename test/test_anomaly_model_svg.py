@@ -0,0 +1,37 @@
+import h5py
+import numpy as np
+
+from common import PatchArray, utils
+from anomalyModelSVG import AnomalyModelSVG
+
+def _generate(filename, images_path, **kwargs):
+    model = AnomalyModelSVG()
+    patches = PatchArray(filename, images_path=images_path, features=kwargs.get("chunk_size") is None)
+    assert model.load_or_generate(patches, **kwargs)
+    assert model.patches.features_loaded == patches.features_loaded    # Not reloaded
+    PatchArray.root = None
+    with h5py.File(filename, "r+") as hf:
+        g = hf[model.NAME]
+        result = (g["mean"][:], g["var"][:], g["mahalanobis_distances"][:])
+        del hf[model.NAME]
+    return result
+
+def test_streamed_model_without_features(features_file, monkeypatch):
+    monkeypatch.setattr(utils, "getComputerInfo", lambda: {})
+    filename, images_path, features, metadata = features_file
+
+    patches = PatchArray(filename, images_path=images_path, features=False)
+    PatchArray.root = None
+    assert patches.contains_features
+    assert not patches.features_loaded
+    assert "features" not in patches.dtype.names
+
+    in_memory = _generate(filename, images_path)
+    streamed  = _generate(filename, images_path, chunk_size=7)
+
+    training = features[metadata["directions"] == 1].reshape(-1, features.shape[-1])
+    np.testing.assert_allclose(in_memory[0], training.mean(axis=0), rtol=1e-5)
+    np.testing.assert_allclose(in_memory[1], training.var(axis=0), rtol=1e-4)
+
+    for a, b in zip(in_memory, streamed):
+        np.testing.assert_allclose(a, b, rtol=1e-5)
@@ -0,0 +1,56 @@
+import numpy as np
+from scipy.spatial import distance
+
+from anomalyModelBalancedDistribution import AnomalyModelBalancedDistribution
+
+def _pinv_distances(distribution, features):
+    """Mahalanobis distances with the pseudo inverse of the covariance (like before the incremental model)"""
+    mean = np.mean(distribution, axis=0, dtype=np.float64)
+    covI = np.linalg.pinv(np.cov(distribution, rowvar=False))
+    return np.array([distance.mahalanobis(f, mean, covI) for f in features])
+
+def _baseline(features, initial_normal_features, threshold_learning, pruning_parameter):
+    """Indices of the Balanced Distribution, one feature vector at a time"""
+    indices = list(range(initial_normal_features))
+    for i in range(initial_normal_features, len(features)):
+        if _pinv_distances(features[indices], features[i:i + 1])[0] > threshold_learning:
+            indices.append(i)
+    indices = np.array(indices)
+    keep = _pinv_distances(features[indices], features[indices]) > threshold_learning * pruning_parameter
+    return indices[keep]
+
+def _features(n, d, seed=0):
+    rng = np.random.RandomState(seed)
+    # Heavy tails so some of the vectors are added to the distribution
+    return rng.standard_t(2, size=(n, d)) * np.linspace(1, 3, d) + 5
+
+def test_incremental_model_matches_pinv():
+    # Starts in a 2 dimensional subspace, so the first updates extend it, the rest are Sherman-Morrison updates
+    features = _features(20, 8)
+    model = AnomalyModelBalancedDistribution()
+
+    model._initialize_learning(features[:3])
+    assert model._rank == 2
+    for i in range(3, len(features)):
+        added = features[:i]
+        probe = _features(5, 8, seed=i)
+        np.testing.assert_allclose(model._learning_distances(probe), _pinv_distances(added, probe), rtol=1e-6)
+        np.testing.assert_allclose(model._pruning_distances(added), _pinv_distances(added, added), rtol=1e-6)
+        model._add_to_distribution(features[i])
+    assert model._rank == 8
+    np.testing.assert_allclose(model._mean, features.mean(axis=0), rtol=1e-12)
+
+def test_generate_model_matches_baseline():
+    features = _features(600, 6, seed=1)
+    patches = np.rec.fromarrays([features, np.arange(len(features), dtype=np.float64)],
+                                dtype=[("features", np.float64, (6,)), ("times", np.float64)]).reshape(60, 2, 5)
+
+    model = AnomalyModelBalancedDistribution(initial_normal_features=10, threshold_learning=3, pruning_parameter=0.3)
+    assert model.__generate_model__(patches, silent=True)
+
+    expected = _baseline(features, 10, 3, 0.3)
+    assert 20 < expected.size < 300, expected.size
+    np.testing.assert_array_equal(model.balanced_distribution.times, expected)
+
+    probe = _features(50, 6, seed=2)
+    np.testing.assert_allclose(model.__mahalanobis_distance_batch__(probe), _pinv_distances(features[expected], probe), rtol=1e-6)
@@ -0,0 +1,54 @@
+import numpy as np
+
+from common import MomentAccumulator
+
+def _features(n=1000, D=16):
+    # Large offset compared to the spread, where the naive sum of squares loses precision
+    rng = np.random.RandomState(1)
+    return (1e4 + rng.randn(n, D) * np.arange(1, D + 1)).astype(np.float32)
+
+def test_update_matches_numpy():
+    features = _features()
+
+    m = MomentAccumulator()
+    for s in range(0, len(features), 77):
+        m.update(features[s:s + 77])
+
+    assert m.count == len(features)
+    np.testing.assert_allclose(m.mean, features.mean(axis=0, dtype=np.float64), rtol=1e-12)
+    np.testing.assert_allclose(m.var, features.astype(np.float64).var(axis=0), rtol=1e-9)
+
+def test_merge_matches_single_pass():
+    features = _features()
+
+    parts = [MomentAccumulator().update(p) for p in np.array_split(features, 5)]
+    merged = MomentAccumulator()
+    for p in parts:
+        merged.merge(p)
+    merged.merge(MomentAccumulator()) # Empty accumulators are ignored
+
+    single = MomentAccumulator().update(features)
+    assert merged.count == single.count
+    np.testing.assert_allclose(merged.mean, single.mean, rtol=1e-12)
+    np.testing.assert_allclose(merged.var, single.var, rtol=1e-9)
+
+def test_update_from_dataset_with_frames(tmp_path):
+    import h5py
+
+    features = _features(n=60 * 6).reshape(60, 2, 3, 16)
+    frames = np.arange(60) % 3 != 0
+    frames[10:20] = False
+
+    with h5py.File(str(tmp_path / "features.h5"), "w") as hf:
+        hf.create_dataset("features", data=features)
+        m = MomentAccumulator().update_from_dataset(hf["features"], frames=frames, chunk_size=7)
+
+    expected = features[frames].reshape(-1, 16).astype(np.float64)
+    assert m.count == expected.shape[0]
+    np.testing.assert_allclose(m.mean, expected.mean(axis=0), rtol=1e-12)
+    np.testing.assert_allclose(m.var, expected.var(axis=0), rtol=1e-9)
+
+def test_empty():
+    m = MomentAccumulator().update(np.zeros((0, 4)))
+    assert m.count == 0
+    assert m.mean is None and m.var is None
@@ -0,0 +1,94 @@
+import os
+
+import h5py
+import numpy as np
+
+from common import PatchArray
+
+def _memmap_base(a):
+    while a is not None and not isinstance(a, np.memmap):
+        a = a.base
+    return a
+
+def test_cache_is_shared_memmap(features_file):
+    filename, images_path, features, _ = features_file
+
+    created = PatchArray(filename, images_path=images_path, cache=True)
+    PatchArray.root = None
+    assert _memmap_base(created) is None    # First call reads the file and writes the cache
+
+    cached = PatchArray(filename, images_path=images_path, cache=True)
+    PatchArray.root = None
+
+    mapped = _memmap_base(cached)
+    assert mapped is not None
+    assert np.shares_memory(cached.features, mapped)
+    assert cached.dtype == created.dtype
+    np.testing.assert_array_equal(cached.features, features)
+
+def test_cache_is_copy_on_write(features_file):
+    filename, images_path, _, _ = features_file
+
+    PatchArray(filename, images_path=images_path, cache=True)
+    PatchArray.root = None
+
+    cached = PatchArray(filename, images_path=images_path, cache=True)
+    PatchArray.root = None
+    cached.locations.tl.y[...] = 5
+
+    again = PatchArray(filename, images_path=images_path, cache=True)
+    assert np.all(again.locations.tl.y == 0)
+
+def test_frame_metadata_join(features_file):
+    filename, images_path, features, metadata = features_file
+
+    patches = PatchArray(filename, images_path=images_path)
+    n, h, w = patches.shape
+
+    # Same values as a copy of the metadata in every patch
+    for name in ("times", "labels", "directions", "round_numbers"):
+        per_patch = np.broadcast_to(metadata[name][:, None, None], (n, h, w))
+        np.testing.assert_array_equal(getattr(patches, name), per_patch)
+        np.testing.assert_array_equal(patches[name], per_patch)
+    np.testing.assert_array_equal(patches.camera_locations.translation.x[:, 1, 2], metadata["camera_locations"]["translation"]["x"])
+
+    # Stored once per frame
+    assert patches.frame_metadata.shape == (n,)
+    assert patches.labels.strides[1:] == (0, 0)
+
+    # Patches, frames, filtered and fancy indexed views
+    assert patches[3, 1, 2].labels == metadata["labels"][3]
+    assert patches[3, 1, 2].times == metadata["times"][3]
+    assert patches[7].camera_locations[0, 0].translation.x == metadata["camera_locations"]["translation"]["x"][7]
+    anomaly = patches.anomaly
+    assert anomaly.shape[0] == np.count_nonzero(metadata["labels"] == 2)
+    assert np.all(anomaly.labels == 2)
+    np.testing.assert_array_equal(patches.training_mask, metadata["directions"] == 1)
+    np.testing.assert_array_equal(patches[[1, 2], [0, 1]].labels, np.broadcast_to(metadata["labels"][[1, 2], None], (2, w)))
+    np.testing.assert_array_equal(patches.ravel()[::h * w].times, metadata["times"])
+
+def test_frame_metadata_set_and_save(features_file):
+    filename, images_path, _, metadata = features_file
+
+    patches = PatchArray(filename, images_path=images_path)
+    frame = np.flatnonzero(metadata["labels"] == 2)[2]
+
+    # A patch changes the metadata of its frame
+    patches.anomaly[2:5][0, 1, 1].stop = 2
+    assert np.all(patches.stop[frame] == 2)
+    assert np.count_nonzero(patches.stop) == patches[frame].size
+    np.testing.assert_array_equal(np.flatnonzero(patches.frame_metadata.changed), [frame])
+
+    # Only frames with a different value are marked as changed
+    patches[10:12].directions = 2
+    assert np.all(patches.directions[10:12] == 2)
+    changed = {frame} | set(10 + np.flatnonzero(metadata["directions"][10:12] != 2))
+    assert set(np.flatnonzero(patches.frame_metadata.changed)) == changed
+
+    assert patches.save_metadata()
+    with h5py.File(os.path.join(images_path, "metadata_cache.h5"), "r") as hf:
+        stop = hf["stop"][5:55]
+        directions = hf["directions"][5:55]
+    np.testing.assert_array_equal(np.flatnonzero(stop), [frame])
+    np.testing.assert_array_equal(directions[10:12], 2)
+    np.testing.assert_array_equal(np.delete(directions, [10, 11]), np.delete(metadata["directions"], [10, 11]))
@@ -0,0 +1,88 @@
+import h5py
+import numpy as np
+from joblib import parallel_backend
+
+from common import Rasterization
+from rasterization import BUFFER
+
+SHAPE  = (12, 15)
+ORIGIN = (-1.0, -2.0)
+CELL   = 0.5
+
+def _corners(n=20, h=2, w=3, seed=0):
+    """Random quadrilateral footprints (n, h, w, 4, 2) inside the grid"""
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform((0.5, 0.5), (4.0, 5.0), size=(n, h, w, 1, 2))
+    return (centers + rng.uniform(-0.4, 0.4, size=(n, h, w, 4, 2))).astype(np.float32)
+
+def _brute_force(corners, shape, origin, cell_size):
+    """The cells whose (closed) square intersects the buffered bounding box of every patch"""
+    corners = corners.reshape(-1, 4, 2).astype(np.float64)
+    lo = corners.min(axis=1) - BUFFER
+    hi = corners.max(axis=1) + BUFFER
+    result = list()
+    for l, h in zip(lo, hi):
+        bins = [v * shape[1] + u for v, u in np.ndindex(shape)
+                if origin[0] + v * cell_size <= h[0] and l[0] <= origin[0] + (v + 1) * cell_size and
+                   origin[1] + u * cell_size <= h[1] and l[1] <= origin[1] + (u + 1) * cell_size]
+        result.append(bins)
+    return result
+
+def _assert_equal(a, b):
+    assert a.shape == b.shape
+    np.testing.assert_array_equal(a.patch_indptr, b.patch_indptr)
+    np.testing.assert_array_equal(a.patch_indices, b.patch_indices)
+    np.testing.assert_array_equal(a.bin_indptr, b.bin_indptr)
+    np.testing.assert_array_equal(a.bin_indices, b.bin_indices)
+
+def _csr(bins):
+    indptr = np.zeros(len(bins) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in bins], out=indptr[1:])
+    return indptr, np.concatenate([np.asarray(b, dtype=np.uint32) for b in bins])
+
+def test_calculate_matches_brute_force():
+    corners = _corners()
+    r = Rasterization.calculate(corners, SHAPE, ORIGIN, CELL)
+
+    expected = _brute_force(corners, SHAPE, ORIGIN, CELL)
+    assert r.num_patches == len(expected)
+    for i, bins in enumerate(expected):
+        np.testing.assert_array_equal(r.bins(i), bins)
+
+    # Both directions describe the same assignment
+    for b in range(r.size):
+        np.testing.assert_array_equal(r.patches(b), [i for i, bins in enumerate(expected) if b in bins])
+
+def test_calculate_multiple_and_parallel():
+    corners = _corners()
+    grids = [(SHAPE, ORIGIN, CELL), ((3, 4), (-1.0, -2.0), 2.0), ((5, 6), (-1.3, -2.1), 1.1)]
+
+    multiple = Rasterization.calculate_multiple(corners, grids)
+    # Threads run the same two passes over the memory-mapped arrays without starting processes
+    with parallel_backend("threading"):
+        parallel = Rasterization.calculate_multiple(corners, grids, n_jobs=2)
+    for grid, m, p in zip(grids, multiple, parallel):
+        expected = Rasterization(grid[0], *_csr(_brute_force(corners, *grid)))
+        _assert_equal(m, expected)
+        _assert_equal(p, expected)
+
+def test_save_append_load(tmp_path):
+    corners = _corners()
+    full = Rasterization.calculate(corners, SHAPE, ORIGIN, CELL)
+    first = Rasterization.calculate(corners[:12], SHAPE, ORIGIN, CELL)
+
+    with h5py.File(str(tmp_path / "features.h5"), "w") as hf:
+        first.save(hf, "0.50")
+        loaded = Rasterization.load(hf, "0.50")
+        _assert_equal(loaded, first)
+        assert loaded.cell_size == CELL
+        np.testing.assert_array_equal(loaded.origin, ORIGIN)
+
+        # Append the other frames (only the patch --> bins direction is written)
+        appended = Rasterization.calculate(corners[:12], SHAPE, ORIGIN, CELL)
+        appended.extend(Rasterization.calculate(corners[12:], SHAPE, ORIGIN, CELL))
+        _assert_equal(appended, full)
+        appended.append(hf, "0.50", first.num_patches)
+
+        _assert_equal(Rasterization.load(hf, "0.50"), full)
+        assert Rasterization.load(hf, "0.20") is None